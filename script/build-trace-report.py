@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Summarizes the timings recorded by configure --enable-build-trace:
+#
+#   build-trace-report.py [--top N] [OUT]
+#
+# OUT is the build's out directory (default: out).  The most recent timing of
+# each edge in OUT/build-trace.jsonl is combined with the edges configure
+# listed in OUT/build-trace-graph.json to print the critical path (the chain
+# of dependent edges whose times add up to the most, which bounds the build
+# no matter how many jobs run at once), the N slowest edges, and the time
+# spent in each tool.
+import sys, os, json, argparse
+
+def load(out):
+    with open(os.path.join(out, 'build-trace-graph.json')) as fp:
+        graph = json.load(fp)
+    latest = {}
+    with open(os.path.join(out, 'build-trace.jsonl')) as fp:
+        for line in fp:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # cut short by an interrupted build
+                continue
+            latest[rec['edge']] = rec
+    return graph, latest
+
+def duration(rec):
+    return rec['end'] - rec['start'] if rec is not None else 0.0
+
+# Returns the edges on the critical path, first to last, and its length.
+def critical_path(graph, latest):
+    producers = {}
+    for edge in graph:
+        for out in edge['outs']:
+            producers[out] = edge
+    best = {}
+    def finish(edge):
+        key = edge['outs'][0]
+        if key in best:
+            return best[key][0]
+        best[key] = (0.0, None)
+        longest, via = 0.0, None
+        for fn in edge['ins']:
+            dep = producers.get(fn)
+            if dep is not None and dep is not edge:
+                t = finish(dep)
+                if t > longest:
+                    longest, via = t, dep
+        best[key] = (longest + duration(latest.get(key)), via)
+        return best[key][0]
+    if not graph:
+        return [], 0.0
+    edge = max(graph, key=finish)
+    total = best[edge['outs'][0]][0]
+    path = []
+    while edge is not None:
+        path.append(edge)
+        edge = best[edge['outs'][0]][1]
+    return path[::-1], total
+
+def describe(rec):
+    if rec is None:
+        return '(not run)'
+    tools = ' + '.join(tool for tool, _ in rec['cmds'] if tool != 'mkdir')
+    if rec['cached']:
+        tools = 'from action cache'
+    if rec['status'] != 0:
+        tools += ', failed with status %d' % (rec['status'],)
+    return tools
+
+def main():
+    parser = argparse.ArgumentParser(description='Report on the timings recorded by configure --enable-build-trace.')
+    parser.add_argument('--top', type=int, default=10, metavar='N', help='how many of the slowest edges to list (default 10)')
+    parser.add_argument('out', nargs='?', default='out', help="the build's out directory (default: out)")
+    args = parser.parse_args()
+    try:
+        graph, latest = load(args.out)
+    except IOError as e:
+        sys.stderr.write('build-trace-report: %s (was configure run with --enable-build-trace, and the build since?)\n' % (e,))
+        return 1
+
+    path, total = critical_path(graph, latest)
+    print('critical path: %.3fs over %d edges' % (total, len(path)))
+    for edge in path:
+        rec = latest.get(edge['outs'][0])
+        print('  %8.3fs  %s  [%s]' % (duration(rec), edge['outs'][0], describe(rec)))
+
+    print('')
+    print('%d slowest edges (of %d timed):' % (min(args.top, len(latest)), len(latest)))
+    for rec in sorted(latest.values(), key=duration, reverse=True)[:args.top]:
+        print('  %8.3fs  %s  [%s]' % (duration(rec), rec['edge'], describe(rec)))
+
+    by_tool = {}
+    for rec in latest.values():
+        for tool, seconds in rec['cmds']:
+            ent = by_tool.setdefault(tool, [0, 0.0])
+            ent[0] += 1
+            ent[1] += seconds
+    print('')
+    print('time by tool:')
+    for tool, (count, seconds) in sorted(by_tool.items(), key=lambda item: -item[1][1]):
+        print('  %8.3fs  %5d  %s' % (seconds, count, tool))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
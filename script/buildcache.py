@@ -0,0 +1,130 @@
+# What script/compile-cache.py and script/mconfig-run.py's action cache have
+# in common: finding the binary a command really runs, and a directory of
+# entries keyed on a hash, with hit/miss statistics and least recently used
+# eviction once it grows past a size limit.
+import os, re, json, subprocess, shutil, fcntl, argparse, errno
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno == errno.EEXIST and os.path.isdir(path):
+            return
+        raise
+
+def parse_size(s):
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)B?$', s.upper())
+    if not m:
+        raise argparse.ArgumentTypeError('bad size %r' % (s,))
+    return int(float(m.group(1)) * 1024 ** ' KMG'.index(m.group(2) or ' '))
+
+def find_program(name):
+    if os.path.sep in name:
+        return name
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        fn = os.path.join(d, name)
+        if os.access(fn, os.X_OK):
+            return fn
+    return name
+
+xcrun_options_with_values = ('--sdk', '-sdk', '--toolchain', '-toolchain')
+
+# The index in argv of the tool xcrun runs, or None if argv isn't an xcrun
+# command naming one.
+def xcrun_tool_index(argv):
+    if os.path.basename(argv[0]) != 'xcrun':
+        return None
+    i = 1
+    while i < len(argv) and argv[i].startswith('-'):
+        i += 2 if argv[i] in xcrun_options_with_values else 1
+    return i if i < len(argv) else None
+
+# Returns the binary argv really runs and the argv prefix that runs it.
+# xcrun picks the tool at run time, so it's asked which one it would pick.
+def resolve_tool(argv):
+    i = xcrun_tool_index(argv)
+    if i is None:
+        return find_program(argv[0]), argv[:1]
+    try:
+        p = subprocess.Popen(argv[:i] + ['-f', argv[i]], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return find_program(argv[0]), argv[:i+1]
+    path = p.communicate()[0].decode('utf-8').strip()
+    if p.returncode != 0 or not path:
+        return find_program(argv[0]), argv[:i+1]
+    return path, argv[:i+1]
+
+def copy_atomically(src, dst):
+    tmp = '%s.tmp%d' % (dst, os.getpid())
+    shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+    # copy2 preserves the mtime; a restored output should look freshly
+    # built, and a stored entry freshly used
+    os.utime(dst, None)
+
+# Entries live in DIR/xx/rest-of-key; subclasses say what an entry is on
+# disk through entry_info and remove_entry.
+class Store(object):
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        makedirs(root)
+
+    def entry(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    # stats.json is only touched with the lock held
+    def update_stats(self, **deltas):
+        with open(os.path.join(self.root, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.read_stats()
+            for key, delta in deltas.items():
+                stats[key] = stats.get(key, 0) + delta
+            if stats.get('size', 0) > self.max_size:
+                stats['size'] = self.evict(self.max_size * 8 // 10)
+                stats['evictions'] = stats.get('evictions', 0) + 1
+            tmp = os.path.join(self.root, 'stats.json.tmp')
+            with open(tmp, 'w') as fp:
+                json.dump(stats, fp, sort_keys=True)
+            os.rename(tmp, os.path.join(self.root, 'stats.json'))
+
+    def read_stats(self):
+        try:
+            with open(os.path.join(self.root, 'stats.json')) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    # (last use, size, handle for remove_entry) for the entry at
+    # DIR/xx/name, or None if name isn't (the main part of) one
+    def entry_info(self, path, name):
+        raise NotImplementedError
+
+    def remove_entry(self, handle):
+        raise NotImplementedError
+
+    # Deletes the least recently used entries until the store is no bigger
+    # than target; returns the new size.
+    def evict(self, target):
+        entries = []
+        for sub in os.listdir(self.root):
+            path = os.path.join(self.root, sub)
+            if len(sub) != 2 or not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if '.tmp' in name:
+                    continue
+                try:
+                    info = self.entry_info(path, name)
+                except OSError:
+                    continue
+                if info is not None:
+                    entries.append(info)
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, handle in entries:
+            if total <= target:
+                break
+            self.remove_entry(handle)
+            total -= size
+        return total
@@ -0,0 +1,44 @@
+#!/bin/sh
+# Builds libsubstitute.dylib with and without LTO and prints the size of each
+# and how long the build took:
+#
+#   script/compare-lto.sh [full|thin] [configure args...]
+#
+# For thin, the time of a relink that can reuse the ThinLTO cache is printed
+# too.  The build directories are left in out/lto-compare/.  $PYTHON (default
+# python3) runs configure, $MAKE (default make) builds, and $JOBS (default:
+# the number of CPUs) is passed to it as -j.
+set -e
+mode="${1:-thin}"
+[ $# -gt 0 ] && shift
+src="$(cd "$(dirname "$0")/.." && pwd)"
+root="$src/out/lto-compare"
+PYTHON="${PYTHON:-python3}"
+MAKE="${MAKE:-make}"
+JOBS="${JOBS:-$(getconf _NPROCESSORS_ONLN 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 4)}"
+now() { "$PYTHON" -c 'import time; print(time.time())'; }
+elapsed() { "$PYTHON" -c "print('%.1fs' % ($2 - $1))"; }
+timed_make() {
+    start=$(now)
+    $MAKE -j"$JOBS" out/libsubstitute.dylib > /dev/null
+    elapsed $start $(now)
+}
+printf '%-6s %12s %10s %10s\n' lto bytes build relink
+for variant in none "$mode"; do
+    dir="$root/$variant"
+    rm -rf "$dir"
+    mkdir -p "$dir"
+    cd "$dir"
+    if [ "$variant" = none ]; then
+        "$PYTHON" "$src/configure" "$@" > /dev/null
+    else
+        "$PYTHON" "$src/configure" --enable-lto="$variant" "$@" > /dev/null
+    fi
+    build=$(timed_make)
+    relink=-
+    if [ "$variant" = thin ]; then
+        rm -f out/libsubstitute.dylib
+        relink=$(timed_make)
+    fi
+    printf '%-6s %12s %10s %10s\n' "$variant" "$(wc -c < out/libsubstitute.dylib | tr -d ' ')" "$build" "$relink"
+done
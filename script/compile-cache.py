@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# Compiler wrapper used by configure --enable-compile-cache=DIR:
+#
+#   compile-cache.py --dir DIR [--max-size SIZE] -- CC ARGS... -c -o OUT -MMD -MF DEP SRC
+#   compile-cache.py --dir DIR --stats
+#
+# The key is a hash of the compiler's identity (the binary it resolves to,
+# through xcrun if need be, with its size and mtime, and its --version), the
+# arguments minus the output file names, and the preprocessed source (once
+# per -arch for multi-arch compiles, since -E refuses those).  On a hit the
+# object and depfile are copied out of DIR; on a miss the compiler runs and
+# its output is stored.  Entries are evicted least recently used first once
+# DIR grows past --max-size.
+import sys, os, re, json, hashlib, subprocess, argparse
+from buildcache import makedirs, parse_size, resolve_tool, copy_atomically, Store
+
+# Splits a compile command into (flags, out, dep, src), or returns None if it
+# doesn't have the shape build_c_objs produces.
+def parse_compile(argv):
+    flags = []
+    out = dep = None
+    i = 1
+    while i < len(argv) - 1:
+        arg = argv[i]
+        if arg == '-o':
+            out = argv[i+1]
+            i += 2
+        elif arg == '-MF':
+            dep = argv[i+1]
+            i += 2
+        elif arg in ('-c', '-MMD'):
+            i += 1
+        else:
+            flags.append(arg)
+            i += 1
+    if out is None or dep is None or '-c' not in argv or '-MMD' not in argv:
+        return None
+    return flags, out, dep, argv[-1]
+
+def compute_key(argv, flags, src):
+    h = hashlib.sha1()
+    identity = compiler_identity(argv)
+    if identity is None:
+        return None
+    h.update(json.dumps([identity, flags, src]).encode('utf-8'))
+    arches = [flags[i+1] for i in range(len(flags) - 1) if flags[i] == '-arch']
+    if len(arches) > 1:
+        variants = []
+        for arch in arches:
+            variant = []
+            i = 0
+            while i < len(flags):
+                if flags[i] == '-arch':
+                    if flags[i+1] == arch:
+                        variant += flags[i:i+2]
+                    i += 2
+                else:
+                    variant.append(flags[i])
+                    i += 1
+            variants.append(variant)
+    else:
+        variants = [flags]
+    for variant in variants:
+        # warnings are the real compile's to print
+        with open(os.devnull, 'w') as devnull:
+            p = subprocess.Popen([argv[0]] + variant + ['-E', src], stdout=subprocess.PIPE, stderr=devnull)
+            while True:
+                chunk = p.stdout.read(65536)
+                if not chunk:
+                    break
+                h.update(chunk)
+            if p.wait() != 0:
+                return None
+    return h.hexdigest()
+
+# The resolved binary's path, size and mtime, plus what it says to --version,
+# which also catches wrapper scripts pointed at a different compiler.
+def compiler_identity(argv):
+    path, prefix = resolve_tool(argv)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    try:
+        p = subprocess.Popen(prefix + ['--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+    version = p.communicate()[0].decode('utf-8', 'replace')
+    return [os.path.realpath(path), st.st_size, st.st_mtime, version]
+
+def escape_make(fn):
+    return re.sub(r'([ :#\\])', r'\\\1', fn).replace('$', '$$')
+
+class Cache(Store):
+    # an entry is a KEY.o and KEY.d pair
+    def entry_info(self, path, name):
+        if not name.endswith('.o'):
+            return None
+        base = os.path.join(path, name[:-2])
+        size = os.path.getsize(base + '.o') + os.path.getsize(base + '.d')
+        return os.path.getmtime(base + '.o'), size, base
+
+    def remove_entry(self, base):
+        for ext in ('.o', '.d'):
+            try:
+                os.remove(base + ext)
+            except OSError:
+                pass
+
+    def fetch(self, key, out, dep):
+        base = self.entry(key)
+        if not (os.path.exists(base + '.o') and os.path.exists(base + '.d')):
+            return False
+        copy_atomically(base + '.o', out)
+        with open(base + '.d') as fp:
+            deps = fp.read()
+        # the cached depfile names whatever object it was compiled to
+        deps = re.sub(r'^(?:\\.|[^:\\])*:', lambda m: escape_make(out) + ':', deps, count=1)
+        with open(dep, 'w') as fp:
+            fp.write(deps)
+        os.utime(base + '.o', None)
+        return True
+
+    def store(self, key, out, dep):
+        base = self.entry(key)
+        makedirs(os.path.dirname(base))
+        copy_atomically(dep, base + '.d')
+        copy_atomically(out, base + '.o')
+        return os.path.getsize(base + '.o') + os.path.getsize(base + '.d')
+
+def print_stats(cache):
+    stats = cache.read_stats()
+    hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+    lookups = hits + misses
+    print('hits:          %d' % (hits,))
+    print('misses:        %d' % (misses,))
+    print('hit rate:      %s' % ('%.1f%%' % (100.0 * hits / lookups) if lookups else '-',))
+    print('uncacheable:   %d' % (stats.get('uncacheable', 0),))
+    print('evictions:     %d' % (stats.get('evictions', 0),))
+    print('size:          %.1f MB (max %.1f MB)' % (stats.get('size', 0) / 1048576.0, cache.max_size / 1048576.0))
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed cache for compile commands.')
+    parser.add_argument('--dir', required=True, help='cache directory')
+    parser.add_argument('--max-size', type=parse_size, default=parse_size('1G'), help='evict entries once the cache is bigger than this (default 1G)')
+    parser.add_argument('--stats', action='store_true', help='print hit/miss statistics and exit')
+    parser.add_argument('argv', nargs=argparse.REMAINDER, help='-- followed by the compile command')
+    args = parser.parse_args()
+    cache = Cache(os.path.abspath(args.dir), args.max_size)
+    if args.stats:
+        print_stats(cache)
+        return 0
+    argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+    if not argv:
+        parser.error('no compile command given')
+    parsed = parse_compile(argv)
+    key = compute_key(argv, parsed[0], parsed[3]) if parsed is not None else None
+    if key is None:
+        cache.update_stats(uncacheable=1)
+        return subprocess.call(argv)
+    flags, out, dep, src = parsed
+    if cache.fetch(key, out, dep):
+        cache.update_stats(hits=1)
+        return 0
+    ret = subprocess.call(argv)
+    cache.update_stats(misses=1, size=cache.store(key, out, dep) if ret == 0 else 0)
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
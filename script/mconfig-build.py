@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# Runs the build graph written by configure --generate=direct (see
+# DirectEmitter in mconfig.py), for systems without make or ninja.
+#
+#   mconfig-build.py GRAPH [-j N] [-n] [target...]
+#
+# An edge is rebuilt if an output is missing, its command changed since the
+# last build (according to the build log next to the graph), or any input -
+# including headers listed in its -MMD depfile - is newer than its oldest
+# output.
+import sys, os, re, json, hashlib, threading, time, argparse
+# subprocess and concurrent.futures are imported only once there's something
+# to run; a no-op build is mostly interpreter startup as it is
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+class BuildError(Exception):
+    pass
+
+def mtime(fn):
+    try:
+        return os.stat(fn).st_mtime
+    except OSError:
+        return None
+
+def argv_to_shell(argv):
+    return ' '.join(map(quote, argv))
+
+def edge_hash(edge):
+    return hashlib.sha1(json.dumps(edge['argvs']).encode('utf-8')).hexdigest()
+
+# Returns the prerequisites listed in a make-style depfile, or None if it
+# can't be read.
+def parse_depfile(fn):
+    try:
+        with open(fn) as fp:
+            data = fp.read()
+    except IOError:
+        return None
+    data = data.replace('\\\n', ' ')
+    deps = []
+    seen_target = False
+    for token in re.findall(r'(?:\\.|[^\s\\])+', data):
+        if token.endswith(':'):
+            seen_target = True
+            continue
+        if seen_target:
+            deps.append(re.sub(r'\\(.)', r'\1', token).replace('$$', '$'))
+    return deps
+
+# One JSON object per line, appended after every edge; later lines win.
+class BuildLog(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.entries = {}
+        self.lines = 0
+        self.lock = threading.Lock()
+        try:
+            with open(fn) as fp:
+                for line in fp:
+                    try:
+                        ent = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[ent['out']] = ent
+                    self.lines += 1
+        except IOError:
+            pass
+        # keep the file from growing without bound
+        if self.lines > 2 * len(self.entries) + 100:
+            with open(fn, 'w') as fp:
+                for ent in self.entries.values():
+                    fp.write(json.dumps(ent, sort_keys=True) + '\n')
+            self.lines = len(self.entries)
+        self.fp = None
+
+    def get(self, out):
+        return self.entries.get(out)
+
+    def record(self, outs, cmd_hash, start, end):
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.fn, 'a')
+            for out in outs:
+                ent = {'out': out, 'hash': cmd_hash, 'start': start, 'end': end}
+                self.entries[out] = ent
+                self.fp.write(json.dumps(ent, sort_keys=True) + '\n')
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+class Builder(object):
+    def __init__(self, graph, log, jobs, dry_run):
+        self.graph = graph
+        self.log = log
+        self.jobs = jobs
+        self.dry_run = dry_run
+        self.producers = {}
+        for edge in graph['edges']:
+            for out in edge['outs']:
+                self.producers[out] = edge
+        self.rebuilt = set()
+        self.print_lock = threading.Lock()
+        self.counter = 0
+
+    # Returns the edges needed for targets, dependencies first.
+    def plan(self, targets):
+        order = []
+        state = {}
+        def visit(edge, via):
+            key = id(edge)
+            if state.get(key) == 'done':
+                return
+            if state.get(key) == 'visiting':
+                raise BuildError('dependency cycle involving %s' % (via,))
+            state[key] = 'visiting'
+            for fn in edge['ins']:
+                dep = self.producers.get(fn)
+                if dep is not None:
+                    visit(dep, fn)
+                elif not os.path.exists(fn):
+                    raise BuildError("'%s', needed by '%s', missing and no known rule to make it" % (fn, edge['outs'][0]))
+            state[key] = 'done'
+            order.append(edge)
+        for target in targets:
+            edge = self.producers.get(target)
+            if edge is None:
+                if os.path.exists(target):
+                    continue
+                raise BuildError("unknown target '%s'" % (target,))
+            visit(edge, target)
+        return order
+
+    def is_dirty(self, edge):
+        if edge['phony']:
+            return bool(edge['argvs'])
+        if any(self.producers.get(fn) is not None and id(self.producers[fn]) in self.rebuilt for fn in edge['ins']):
+            return True
+        out_mtimes = [mtime(out) for out in edge['outs']]
+        if None in out_mtimes:
+            return True
+        ent = self.log.get(edge['outs'][0])
+        if ent is None or ent['hash'] != edge_hash(edge):
+            return True
+        deps = list(edge['ins'])
+        if edge['depfile'] is not None:
+            more = parse_depfile(edge['depfile'])
+            if more is None:
+                return True
+            deps += more
+        oldest = min(out_mtimes)
+        for fn in deps:
+            m = mtime(fn)
+            if m is None or m > oldest:
+                return True
+        return False
+
+    def run_edge(self, edge, total):
+        start = time.time()
+        for argv in edge['argvs']:
+            with self.print_lock:
+                self.counter += 1
+                sys.stdout.write('[%d/%d] %s\n' % (self.counter, total, argv_to_shell(argv)))
+                sys.stdout.flush()
+            if self.dry_run:
+                continue
+            import subprocess
+            try:
+                p = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError as e:
+                raise BuildError('%s: %s' % (argv[0], e))
+            output = p.communicate()[0]
+            if output:
+                with self.print_lock:
+                    sys.stdout.flush()
+                    getattr(sys.stdout, 'buffer', sys.stdout).write(output)
+                    sys.stdout.flush()
+            if p.returncode != 0:
+                raise BuildError("'%s' failed with status %d" % (edge['outs'][0], p.returncode))
+        if not edge['phony'] and not self.dry_run:
+            self.log.record(edge['outs'], edge_hash(edge), start, time.time())
+
+    def build(self, targets):
+        order = self.plan(targets)
+        deps = {}
+        users = {}
+        for edge in order:
+            mine = set()
+            for fn in edge['ins']:
+                dep = self.producers.get(fn)
+                if dep is not None and id(dep) not in mine:
+                    mine.add(id(dep))
+                    users.setdefault(id(dep), []).append(edge)
+            deps[id(edge)] = mine
+        # commands, not edges, are counted in the progress display; this is
+        # only an upper bound until staleness is known
+        total = sum(len(edge['argvs']) for edge in order)
+        ready = [edge for edge in order if not deps[id(edge)]]
+        # finish off everything that's up to date before starting any threads
+        while ready and not self.is_dirty(ready[0]):
+            ready.extend(self.finish(ready.pop(0), deps, users, rebuilt=False))
+        if not ready:
+            sys.stdout.write('mconfig-build: no work to do.\n')
+            return True
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        running = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while ready or running:
+                while ready and not failed:
+                    edge = ready.pop(0)
+                    if self.is_dirty(edge):
+                        running[pool.submit(self.run_edge, edge, total)] = edge
+                    else:
+                        ready.extend(self.finish(edge, deps, users, rebuilt=False))
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    edge = running.pop(future)
+                    try:
+                        future.result()
+                    except BuildError as e:
+                        failed.append(e)
+                        continue
+                    ready.extend(self.finish(edge, deps, users, rebuilt=True))
+        if failed:
+            for e in failed:
+                sys.stderr.write('mconfig-build: %s\n' % (e,))
+            return False
+        return True
+
+    def finish(self, edge, deps, users, rebuilt):
+        if rebuilt:
+            self.rebuilt.add(id(edge))
+        newly_ready = []
+        for user in users.get(id(edge), []):
+            deps[id(user)].discard(id(edge))
+            if not deps[id(user)]:
+                newly_ready.append(user)
+        return newly_ready
+
+def cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+def load_graph(fn):
+    with open(fn) as fp:
+        return json.load(fp)
+
+# Reruns config.status if any configure script is newer than the stamp it
+# touches, and returns the (possibly new) graph.
+def maybe_regenerate(graph_fn, graph):
+    regen = graph.get('regen')
+    if regen is None:
+        return graph
+    stamp_mtime = mtime(regen['stamp'])
+    if stamp_mtime is not None and all((mtime(fn) or 0) <= stamp_mtime for fn in regen['ins']):
+        return graph
+    sys.stdout.write('Running config.status...\n')
+    sys.stdout.flush()
+    import subprocess
+    if subprocess.call(regen['argv']) != 0:
+        raise BuildError('config.status failed')
+    return load_graph(graph_fn)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build targets from a configure --generate=direct graph.')
+    parser.add_argument('graph', help='the build-graph.json written by configure')
+    parser.add_argument('-j', dest='jobs', type=int, default=cpu_count(), help='number of commands to run in parallel (default: number of CPUs)')
+    parser.add_argument('-n', dest='dry_run', action='store_true', help="print commands instead of running them")
+    parser.add_argument('targets', nargs='*', help='targets to build (default: the default target)')
+    args = parser.parse_args()
+    graph_fn = os.path.abspath(args.graph)
+    graph = load_graph(graph_fn)
+    os.chdir(graph['root'])
+    log = None
+    try:
+        graph = maybe_regenerate(graph_fn, graph)
+        targets = args.targets or ([graph['default']] if graph.get('default') else [])
+        if not targets:
+            raise BuildError('no targets given and no default target')
+        log = BuildLog(os.path.join(os.path.dirname(graph_fn), 'build-log.jsonl'))
+        ok = Builder(graph, log, max(1, args.jobs), args.dry_run).build(targets)
+    except BuildError as e:
+        sys.stderr.write('mconfig-build: %s\n' % (e,))
+        ok = False
+    finally:
+        if log is not None:
+            log.close()
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
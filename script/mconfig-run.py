@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# Runs the commands of one build edge on behalf of the generated build
+# script, adding features make and ninja don't have:
+#
+#   mconfig-run.py [--action-cache DIR --key KEY --out OUT... --in IN...
+#                   --flag-file FILE...]
+#                  [--trace FILE --edge NAME] [--pool DIR --pool-depth N]
+#                  --cmd JSON
+#
+# --cmd is a JSON list of argvs, run in order until one fails.
+#
+# With --action-cache, KEY (the edge's rule hash) plus the contents of the
+# inputs and of the files named inside the commands' flags (--flag-file; one
+# that doesn't exist counts as missing rather than making the edge
+# uncacheable), and the identity of the tools run (the binaries they resolve
+# to, through xcrun if need be) select an entry in DIR; if there is one its
+# copies of the outputs are restored instead of running anything, otherwise
+# the outputs are stored there after a successful run.  Entries are evicted
+# least recently used first once DIR grows past --max-size.
+#
+# With --trace, a JSON line with the edge's start and end times, exit status
+# and the time taken by each command is appended to FILE when it's done; see
+# script/build-trace-report.py.
+#
+# With --pool, at most N edges using the same DIR run at once (the commands,
+# that is; waiting happens first).  This is make's version of a ninja pool.
+# Under GNU make -j, the job slot this edge occupies is handed back to the
+# jobserver while it waits, so compiles can use it.
+import sys, os, re, json, hashlib, subprocess, shutil, fcntl, argparse, errno, time
+from buildcache import makedirs, parse_size, resolve_tool, xcrun_tool_index, copy_atomically, Store
+
+def hash_file(fn):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as fp:
+        while True:
+            chunk = fp.read(65536)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# What a command's time is reported under: the tool a wrapper such as
+# compile-cache.py or xcrun runs rather than the wrapper itself.
+wrapper_scripts = ('compile-cache.py', 'mconfig-run.py')
+def tool_name(argv):
+    while len(argv) > 1 and os.path.basename(argv[1]) in wrapper_scripts and '--' in argv:
+        argv = argv[argv.index('--')+1:]
+    i = xcrun_tool_index(argv) if argv else None
+    if i is not None:
+        argv = argv[i:]
+    return os.path.basename(argv[0]) if argv else '?'
+
+# timings, if given, gets a [tool, seconds] pair per command run
+def run_commands(argvs, timings=None):
+    for argv in argvs:
+        start = time.time()
+        try:
+            ret = subprocess.call(argv)
+        except OSError as e:
+            sys.stderr.write('%s: %s\n' % (argv[0], e))
+            return 127
+        finally:
+            if timings is not None:
+                timings.append([tool_name(argv), time.time() - start])
+        if ret != 0:
+            return ret
+    return 0
+
+# one write to a file opened for appending, so lines from parallel edges
+# don't interleave
+def append_trace(fn, record):
+    fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+# The jobserver GNU make advertises in MAKEFLAGS, as a (read fd, write fd)
+# pair, or None.  Pipe fds are only inherited by recipes make considers
+# recursive, so in practice this needs make 4.4's named pipe.
+def open_jobserver():
+    m = re.search(r'--jobserver-(?:auth|fds)=(\S+)', os.environ.get('MAKEFLAGS', ''))
+    if not m:
+        return None
+    auth = m.group(1)
+    if auth.startswith('fifo:'):
+        try:
+            fd = os.open(auth[5:], os.O_RDWR)
+        except OSError:
+            return None
+        return fd, fd
+    try:
+        fds = tuple(map(int, auth.split(',')))
+        for fd in fds:
+            os.fstat(fd)
+    except (ValueError, OSError):
+        return None
+    return fds if len(fds) == 2 else None
+
+class Pool(object):
+    def __init__(self, root, depth):
+        self.root = root
+        self.depth = depth
+        self.slot = None
+        makedirs(root)
+
+    def try_acquire(self):
+        for i in range(self.depth):
+            fp = open(os.path.join(self.root, 'slot%d' % (i,)), 'a')
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                fp.close()
+                continue
+            self.slot = fp
+            return True
+        return False
+
+    def acquire(self):
+        if self.try_acquire():
+            return
+        jobserver = open_jobserver()
+        if jobserver is not None:
+            # lend make our job slot while we wait
+            os.write(jobserver[1], b'+')
+        try:
+            while not self.try_acquire():
+                time.sleep(0.05)
+        finally:
+            if jobserver is not None:
+                # and take one back before doing any work
+                while True:
+                    try:
+                        if os.read(jobserver[0], 1):
+                            break
+                    except OSError as e:
+                        if e.errno not in (errno.EINTR, errno.EAGAIN):
+                            raise
+                        time.sleep(0.05)
+
+    def release(self):
+        if self.slot is not None:
+            self.slot.close()
+            self.slot = None
+
+class ActionCache(Store):
+    # Returns None if some input can't be hashed (e.g. a directory).
+    def key(self, rule_key, ins, argvs, flag_files=()):
+        h = hashlib.sha1(rule_key.encode('utf-8'))
+        try:
+            for fn in ins:
+                h.update(('%s %s\n' % (fn, hash_file(fn))).encode('utf-8'))
+            for fn in flag_files:
+                if os.path.isfile(fn):
+                    digest = hash_file(fn)
+                else:
+                    digest = 'directory' if os.path.isdir(fn) else 'missing'
+                h.update(('flag %s %s\n' % (fn, digest)).encode('utf-8'))
+        except (IOError, OSError):
+            return None
+        for argv in argvs:
+            path = resolve_tool(argv)[0]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            h.update(('%s %s %d %r\n' % (argv[0], os.path.realpath(path), st.st_size, st.st_mtime)).encode('utf-8'))
+        return h.hexdigest()
+
+    def fetch(self, key, outs):
+        entry = self.entry(key)
+        if not all(os.path.exists(os.path.join(entry, str(i))) for i in range(len(outs))):
+            return False
+        for i, out in enumerate(outs):
+            makedirs(os.path.dirname(out) or '.')
+            copy_atomically(os.path.join(entry, str(i)), out)
+        os.utime(entry, None)
+        return True
+
+    # Only regular files are stored; an edge producing anything else (e.g.
+    # a symlink) is simply rerun every time.
+    def store(self, key, outs):
+        if not all(os.path.isfile(out) and not os.path.islink(out) for out in outs):
+            return 0
+        entry = self.entry(key)
+        tmp = '%s.tmp%d' % (entry, os.getpid())
+        makedirs(tmp)
+        for i, out in enumerate(outs):
+            shutil.copy2(out, os.path.join(tmp, str(i)))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # someone else stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return 0
+        return sum(os.path.getsize(out) for out in outs)
+
+    # an entry is a directory holding a copy of each output
+    def entry_info(self, path, name):
+        entry = os.path.join(path, name)
+        size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+        return os.path.getmtime(entry), size, entry
+
+    def remove_entry(self, entry):
+        shutil.rmtree(entry, ignore_errors=True)
+
+# returns (exit status, whether the outputs came from the action cache)
+def run_edge(args, argvs, timings):
+    if args.action_cache is None:
+        return run_commands(argvs, timings), False
+    cache = ActionCache(os.path.abspath(args.action_cache), args.max_size)
+    key = cache.key(args.key, args.ins, argvs, args.flag_files)
+    if key is None:
+        cache.update_stats(uncacheable=1)
+        return run_commands(argvs, timings), False
+    if cache.fetch(key, args.out):
+        cache.update_stats(hits=1)
+        return 0, True
+    ret = run_commands(argvs, timings)
+    cache.update_stats(misses=1, size=cache.store(key, args.out) if ret == 0 else 0)
+    return ret, False
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the commands of a build edge.')
+    parser.add_argument('--cmd', required=True, help='JSON list of argvs to run')
+    parser.add_argument('--action-cache', metavar='DIR', help='reuse outputs from DIR when the inputs match')
+    parser.add_argument('--max-size', type=parse_size, default=parse_size('1G'), help='size limit for the action cache (default 1G)')
+    parser.add_argument('--key', help="the edge's rule hash")
+    parser.add_argument('--out', action='append', default=[], help='an output of the edge')
+    parser.add_argument('--in', dest='ins', action='append', default=[], help='an input of the edge')
+    parser.add_argument('--flag-file', dest='flag_files', action='append', default=[], help='a file named in a flag, hashed if it exists')
+    parser.add_argument('--trace', metavar='FILE', help='append the timing of this edge to FILE')
+    parser.add_argument('--edge', help='name of the edge in the trace (its first output)')
+    parser.add_argument('--pool', metavar='DIR', help='directory of the lock files of a pool to run in')
+    parser.add_argument('--pool-depth', type=int, metavar='N', help='how many edges the pool runs at once')
+    args = parser.parse_args()
+    argvs = json.loads(args.cmd)
+    if args.action_cache is not None and (args.key is None or not args.out):
+        parser.error('--action-cache needs --key and --out')
+    if args.trace is not None and args.edge is None:
+        parser.error('--trace needs --edge')
+    if args.pool is not None and not args.pool_depth:
+        parser.error('--pool needs --pool-depth')
+    pool = None
+    if args.pool is not None:
+        pool = Pool(os.path.abspath(args.pool), args.pool_depth)
+        pool.acquire()
+    try:
+        start = time.time()
+        timings = []
+        ret, cached = run_edge(args, argvs, timings)
+    finally:
+        if pool is not None:
+            pool.release()
+    if args.trace is not None:
+        append_trace(args.trace, {'edge': args.edge, 'start': start, 'end': time.time(), 'status': ret, 'cached': cached, 'cmds': timings})
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-import re, argparse, sys, os, string, shlex, subprocess, glob, parser, hashlib, json, errno
+import re, argparse, sys, os, string, shlex, subprocess, glob, hashlib, json, errno, threading, multiprocessing, time, difflib
 from collections import OrderedDict, namedtuple
 import curses.ascii
 
@@ -17,12 +17,68 @@ def makedirs(path):
             return
         raise
 
+# Writes data to fn through a temporary file and a rename, unless fn already
+# has exactly that content, in which case it (and its mtime) is left alone.
+# Returns whether the file was written.
+def write_file_if_changed(fn, data):
+    try:
+        with open(fn) as fp:
+            changed = fp.read() != data
+    except (IOError, OSError, UnicodeDecodeError):
+        changed = True
+    if changed:
+        tmp_fn = '%s.tmp%d' % (fn, os.getpid())
+        with open(tmp_fn, 'w') as fp:
+            fp.write(data)
+        os.rename(tmp_fn, fn)
+    return changed
+
 def indentify(s, indent='    '):
     return s.replace('\n', '\n' + indent)
 
+# While will_need tests run in parallel, each test (and each memoized probe
+# it computes) writes to its own LogBuffer; the buffers are replayed in test
+# order afterwards, so stdout and config.log come out as if run serially.
+class LogBuffer(object):
+    def __init__(self):
+        self.bits = []
+    def write(self, x, to_stdout):
+        self.bits.append((x, to_stdout))
+    def include(self, other):
+        self.bits.append(other)
+    # seen: buffers already replayed (a memoized probe's output is only shown
+    # the first time)
+    def replay(self, seen):
+        for bit in self.bits:
+            if isinstance(bit, LogBuffer):
+                if bit not in seen:
+                    seen.add(bit)
+                    bit.replay(seen)
+            else:
+                x, to_stdout = bit
+                if to_stdout:
+                    sys.stdout.write(x)
+                config_log.write(x)
+
+log_state = threading.local()
+def current_log_buffer():
+    return getattr(log_state, 'buffer', None)
+
 def log(x):
-    sys.stdout.write(x)
-    config_log.write(x)
+    buf = current_log_buffer()
+    if buf is not None:
+        buf.write(x, True)
+    else:
+        sys.stdout.write(x)
+        config_log.write(x)
+
+# config.log only
+def log_to_file(x):
+    buf = current_log_buffer()
+    if buf is not None:
+        buf.write(x, False)
+    else:
+        config_log.write(x)
 
 def to_upper_and_underscore(s):
     return s.upper().replace('-', '_')
@@ -49,59 +105,298 @@ def argv_to_shell(argv):
 
 def init_config_log():
     global config_log
-    config_log = open('config.log', 'w')
+    # the second run of --self-check-emission leaves config.log alone
+    config_log = open(os.devnull if emission_snapshot_fn is not None else 'config.log', 'w')
     config_log.write(argv_to_shell(sys.argv) + '\n')
 
 # a wrapper for subprocess that logs results
 # returns (stdout, stderr, status) [even if Popen fails]
 def run_command(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs):
     shell = argv_to_shell(cmd)
-    config_log.write("Running command '%s'\n" % (shell,))
+    log_to_file("Running command '%s'\n" % (shell,))
 
-    isatty = sys.stdout.isatty()
+    isatty = sys.stdout.isatty() and current_log_buffer() is None
     if isatty:
         sys.stdout.write('>>> ' + shell) # no \n
         sys.stdout.flush()
 
-    try:
-        p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, **kwargs)
-    except OSError:
-        config_log.write('  OSError\n')
-        return '', '', 127
-    so, se = [o.decode('utf-8') for o in p.communicate()]
+    with profiler.span(shell, 'command'):
+        try:
+            p = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, **kwargs)
+        except OSError:
+            log_to_file('  OSError\n')
+            return '', '', 127
+        so, se = [o.decode('utf-8') for o in p.communicate()]
 
     if isatty:
         sys.stdout.write('\033[2K\r')
 
     if p.returncode != 0:
-        config_log.write('  failed with status %d\n' % (p.returncode,))
-    config_log.write('-----------\n')
-    config_log.write('  stdout:\n')
-    config_log.write(so.rstrip())
-    config_log.write('\n  stderr:\n')
-    config_log.write(se.rstrip())
-    config_log.write('\n-----------\n')
+        log_to_file('  failed with status %d\n' % (p.returncode,))
+    log_to_file('-----------\n')
+    log_to_file('  stdout:\n')
+    log_to_file(so.rstrip())
+    log_to_file('\n  stderr:\n')
+    log_to_file(se.rstrip())
+    log_to_file('\n-----------\n')
     return so, se, p.returncode
 
 class DependencyNotFoundException(Exception):
     pass
 
 # it must take no arguments, and throw DependencyNotFoundException on failure
+# if cache_key is given, it is called to get a key into config.cache, which is
+# consulted before calling f; cache_files(result) lists the files whose mtimes
+# the cached result depends on
+# thread safe: concurrent callers wait for the first one to finish
 class memoize(object):
-    def __init__(self, f):
+    def __init__(self, f, cache_key=None, cache_files=None):
         self.f = f
+        self.cache_key = cache_key
+        self.cache_files = cache_files
+        self.from_cache = False
+        self.lock = threading.RLock()
+        self.log_buffer = None
     def __call__(self):
+        with self.lock:
+            try:
+                return self.call_locked()
+            finally:
+                caller = current_log_buffer()
+                if caller is not None and self.log_buffer is not None:
+                    caller.include(self.log_buffer)
+    def call_locked(self):
         if hasattr(self, 'threw'):
             raise self.threw
         elif hasattr(self, 'result'):
             return self.result
         else:
+            caller = current_log_buffer()
+            if caller is not None:
+                self.log_buffer = log_state.buffer = LogBuffer()
             try:
-                self.result = self.f()
+                with profiler.span(self.describe(), 'probe') as span:
+                    self.result = self.compute()
+                    span.args['cached'] = self.from_cache
                 return self.result
             except DependencyNotFoundException as threw:
                 self.threw = threw
                 raise
+            finally:
+                log_state.buffer = caller
+    def describe(self):
+        f = self.f
+        owner = getattr(f, '__self__', None)
+        if owner is None:
+            return f.__name__
+        desc = getattr(owner, 'name', type(owner).__name__)
+        machine = getattr(owner, 'machine', None)
+        if machine is not None:
+            desc = '%s:%s' % (machine.name, desc)
+        return '%s.%s' % (desc, f.__name__)
+    def compute(self):
+        if self.cache_key is None:
+            return self.f()
+        key = self.cache_key()
+        hit = config_state.get(key) or config_cache.get(key)
+        if hit is not None:
+            self.from_cache = True
+            config_state.put(key, hit[0])
+            return hit[0]
+        result = self.f()
+        files = self.cache_files(result) if self.cache_files is not None else []
+        config_cache.put(key, result, files)
+        config_state.put(key, result)
+        return result
+
+def file_mtime(fn):
+    try:
+        return os.stat(fn).st_mtime
+    except OSError:
+        return None
+
+# Results of expensive probes, kept in (out)/config.cache between runs.  The
+# whole thing is thrown away if PATH or any tool/flag environment variable
+# changed; each entry is also checked against the mtimes of the files it
+# depends on (usually the tools that were found).
+class ConfigCache(object):
+    def __init__(self):
+        self.entries = {}
+        self.loaded = False
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def filename(self):
+        return os.path.join(settings_root.out, 'config.cache')
+
+    def fingerprint(self):
+        env = [(name, os.environ.get(name)) for name in sorted(opt.name[:-1] for opt in all_options if opt.is_env)]
+        # normalize through JSON so it compares equal to the loaded version
+        return json.loads(json.dumps({'PATH': os.environ.get('PATH', ''), 'env': env}))
+
+    def enabled(self):
+        return not settings_root.disable_config_cache
+
+    def load(self):
+        self.loaded = True
+        if not self.enabled() or settings_root.recheck:
+            return
+        fn = self.filename()
+        try:
+            with open(fn) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return
+        if data.get('fingerprint') != self.fingerprint():
+            log('Environment changed since last run; not using %s\n' % (fn,))
+            return
+        self.entries = data.get('entries', {})
+
+    def get(self, key):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            ent = self.entries.get(key)
+            if ent is None:
+                return None
+            for fn, mtime in ent['mtimes'].items():
+                if file_mtime(fn) != mtime:
+                    del self.entries[key]
+                    return None
+        log_to_file('Using cached result for %r\n' % (key,))
+        return (ent['value'],)
+
+    def put(self, key, value, files):
+        mtimes = {fn: file_mtime(fn) for fn in files}
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.entries[key] = {'value': value, 'mtimes': mtimes}
+            self.dirty = True
+
+    def save(self):
+        if not (self.dirty and self.enabled()):
+            return
+        fn = self.filename()
+        makedirs(dirname(fn))
+        write_file_if_changed(fn, json.dumps({'fingerprint': self.fingerprint(), 'entries': self.entries}, indent=1, sort_keys=True))
+        self.dirty = False
+
+# Every probe result of this run, saved to (out)/config-state.json for
+# config.status, which passes --replay-state.  If the command line (minus
+# that option) and the environment are the same as when the state was saved,
+# the results are reused without touching config.cache or checking any mtimes;
+# otherwise configure probes as usual.
+class ConfigState(object):
+    def __init__(self):
+        self.results = {}
+        self.replaying = False
+        self.lock = threading.Lock()
+
+    def filename(self):
+        return os.path.join(settings_root.out, 'config-state.json')
+
+    def fingerprint(self):
+        return dict(config_cache.fingerprint(), argv=configure_argv())
+
+    def replay(self, fn):
+        if settings_root.recheck:
+            return
+        try:
+            with open(fn) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return
+        if data.get('fingerprint') != self.fingerprint():
+            log('Command line or environment changed; probing again\n')
+            return
+        log_to_file('Replaying configuration from %s\n' % (fn,))
+        self.results = data.get('results', {})
+        self.replaying = True
+
+    def get(self, key):
+        if not self.replaying:
+            return None
+        with self.lock:
+            if key not in self.results:
+                return None
+            return (self.results[key],)
+
+    def put(self, key, value):
+        with self.lock:
+            self.results[key] = value
+
+    def save(self):
+        fn = self.filename()
+        makedirs(dirname(fn))
+        write_file_if_changed(fn, json.dumps({'fingerprint': self.fingerprint(), 'results': self.results}, indent=1, sort_keys=True))
+
+# sys.argv, minus the options config.status adds
+def configure_argv():
+    argv = []
+    skip = False
+    for arg in sys.argv:
+        if skip:
+            skip = False
+        elif arg == '--replay-state':
+            skip = True
+        elif not arg.startswith('--replay-state='):
+            argv.append(arg)
+    return argv
+
+# Timings of commands, probes and phases of this run.  They're always
+# collected (it's cheap); with --profile-configure they're written next to
+# config.log as a Chrome trace (chrome://tracing, Perfetto) and a summary.
+class ConfigProfiler(object):
+    def __init__(self):
+        self.start = self.parsed_at = time.time()
+        self.events = []
+        self.tids = {}
+        self.lock = threading.Lock()
+
+    def span(self, name, cat, **args):
+        return ProfilerSpan(self, name, cat, args)
+
+    def add(self, name, cat, start, end, args):
+        with self.lock:
+            tid = self.tids.setdefault(threading.current_thread().ident, len(self.tids) + 1)
+            self.events.append((name, cat, start, end, tid, args))
+
+    def trace(self):
+        events = [{'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+                   'ts': int((start - self.start) * 1e6), 'dur': int((end - start) * 1e6), 'args': args}
+                  for name, cat, start, end, tid, args in self.events]
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, indent=1, sort_keys=True)
+
+    # spans nest, so the totals of probes include the commands they ran
+    def summary(self):
+        totals = {}
+        for name, cat, start, end, tid, args in self.events:
+            ent = totals.setdefault((cat, name), [0, 0.0, 0.0])
+            ent[0] += 1
+            ent[1] += end - start
+            ent[2] = max(ent[2], end - start)
+        lines = ['configure took %.3fs\n' % (time.time() - self.start,),
+                 '%9s %9s %6s  %-8s %s\n' % ('total', 'max', 'count', 'kind', 'what')]
+        for (cat, name), (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append('%8.3fs %8.3fs %6d  %-8s %s\n' % (total, longest, count, cat, name))
+        return ''.join(lines)
+
+    def save(self):
+        write_file_loudly('config-profile.json', self.trace())
+        write_file_loudly('config-profile.txt', self.summary())
+
+class ProfilerSpan(object):
+    def __init__(self, profiler, name, cat, args):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+        self.args = args
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.cat, self.start, time.time(), self.args)
 
 class Pending(object):
     def __repr__(self):
@@ -142,7 +437,7 @@ class SettingsGroup(object):
             inherit_parent = object.__getattribute__(self, 'inherit_parent')
             if inherit_parent is not None:
                 ret = SettingsGroup.get_meat(inherit_parent, attr, exctype)
-                if isinstance(ret, SettingsGroup):
+                if isinstance(ret, (SettingsGroup, FrozenSettingsGroup)):
                     ret = self[attr] = ret.specialize(name='%s.%s' % (object.__getattribute__(self, 'name'), attr), group_parent=self)
                 return ret
             raise exctype(attr)
@@ -217,6 +512,94 @@ class SettingsGroup(object):
         self[name] = sg
         return sg
 
+    # Returns a read-only FrozenSettingsGroup with the values of this group and
+    # everything it inherits from, Pending values resolved.  Child groups are
+    # frozen too.  Meant for use after parse_args, once the configure script is
+    # done tweaking settings.
+    def freeze(self, group_parent=None, _frozen=None):
+        assert did_parse_args
+        if _frozen is None:
+            _frozen = {}
+        chain = []
+        o = self
+        while o is not None:
+            chain.append(o)
+            o = object.__getattribute__(o, 'inherit_parent')
+        vals = {}
+        for o in reversed(chain):
+            vals.update(object.__getattribute__(o, 'vals'))
+        if group_parent is None:
+            group_parent = object.__getattribute__(self, 'group_parent')
+        frozen = FrozenSettingsGroup(vals, object.__getattribute__(self, 'name'), group_parent)
+        _frozen[id(self)] = frozen
+        for attr, val in vals.items():
+            if isinstance(val, Pending):
+                try:
+                    vals[attr] = val.resolve()
+                except:
+                    pass # complain if someone actually asks for it
+            elif isinstance(val, SettingsGroup):
+                if id(val) in _frozen:
+                    vals[attr] = _frozen[id(val)]
+                else:
+                    vals[attr] = val.freeze(group_parent=frozen, _frozen=_frozen)
+        return frozen
+
+# See SettingsGroup.freeze.  Lookups are a single dict access rather than a
+# walk up the inherit_parent chain; specialize() returns a normal
+# SettingsGroup inheriting from the snapshot, so overrides go there.
+class FrozenSettingsGroup(object):
+    __slots__ = ('vals', 'name', 'group_parent')
+    inherit_parent = None
+    def __init__(self, vals, name, group_parent):
+        object.__setattr__(self, 'vals', vals)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'group_parent', group_parent)
+    def lookup(self, attr, exctype):
+        try:
+            obj = self.vals[attr]
+        except KeyError:
+            raise exctype(attr)
+        if isinstance(obj, Pending):
+            try:
+                return obj.resolve()
+            except:
+                raise Exception("setting %r is pending; you need to set it" % (attr,))
+        return obj
+    def __getattr__(self, attr):
+        return self.lookup(attr, AttributeError)
+    def __getitem__(self, attr):
+        return self.lookup(attr, KeyError)
+    def __setattr__(self, attr, val):
+        raise TypeError("can't set %r on frozen settings %s" % (attr, self.name))
+    __setitem__ = __setattr__
+    def get(self, attr, default=None):
+        try:
+            return self[attr]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return self.vals.__iter__()
+    def items(self):
+        return self.vals.items()
+
+    def __str__(self):
+        s = 'FrozenSettingsGroup %s {\n' % (self.name,)
+        for attr, val in sorted(self.vals.items()):
+            s += '    %s: %s\n' % (attr, indentify(str(val)))
+        s += '}'
+        return s
+
+    def specialize(self, name=None, group_parent=None, **kwargs):
+        sg = SettingsGroup(inherit_parent=self, group_parent=group_parent, name=name)
+        for key, val in kwargs.items():
+            sg[key] = val
+        return sg
+
+    def freeze(self, group_parent=None):
+        return self
+
 class OptSection(object):
     def __init__(self, desc):
         self.desc = desc
@@ -282,6 +665,41 @@ class Option(object):
         if self.on_set is not None:
             self.on_set(value)
 
+# Expander format strings are literal text with embedded (expr), replaced by
+# the value of the Python expression expr evaluated against a settings object,
+# or (*expr), which expand_argv splits into multiple arguments.  The end of
+# each expression is found by a small tokenizer that skips string literals and
+# nested brackets, so a format string is scanned exactly once.
+expander_token_re = re.compile(r'''
+    (?P<string> \'\'\'(?:[^\\]|\\.)*?\'\'\' | """(?:[^\\]|\\.)*?"""
+              | '(?:[^'\\\n]|\\.)*' | "(?:[^"\\\n]|\\.)*" )
+  | (?P<open> [(\[{] )
+  | (?P<close> [)\]}] )
+  | (?P<other> [^'"()\[\]{}]+ )
+''', re.X | re.S)
+expander_closers = {'(': ')', '[': ']', '{': '}'}
+
+# returns the index of the ')' ending the expression that starts at start
+def scan_expander_expr(fmt, start):
+    stack = []
+    pos = start
+    while True:
+        m = expander_token_re.match(fmt, pos)
+        if m is None:
+            raise SyntaxError('unterminated expression in %r' % (fmt,))
+        kind = m.lastgroup
+        if kind == 'open':
+            stack.append(expander_closers[m.group()])
+        elif kind == 'close':
+            if not stack:
+                if m.group() != ')':
+                    raise SyntaxError('unbalanced %r in %r' % (m.group(), fmt))
+                return pos
+            if stack.pop() != m.group():
+                raise SyntaxError('unbalanced %r in %r' % (m.group(), fmt))
+        pos = m.end()
+
+# returns a list of literal strings and (code, should_shlex_result) tuples
 def parse_expander(fmt):
     bits = []
     z = 0
@@ -295,46 +713,102 @@ def parse_expander(fmt):
         if fmt[y+1:y+2] == '*':
             should_shlex_result = True
             y += 1
-        try:
-            parser.expr(fmt[y+1:])
-        except SyntaxError as e:
-            offset = e.offset
-            if offset == 0 or fmt[y+1+offset-1] != ')':
-                raise
-            bits.append((compile(fmt[y+1:y+1+offset-1], '<string>', 'eval'), should_shlex_result))
-            z = y+1+offset
+        end = scan_expander_expr(fmt, y+1)
+        bits.append((compile(fmt[y+1:end], '<string>', 'eval'), should_shlex_result))
+        z = end+1
     return bits
 
-def eval_expand_bit(bit, settings, extra_vars={}):
-    dep = eval(bit, {}, settings.specialize(**extra_vars))
+def eval_expand_bit(code, scope):
+    dep = eval(code, {}, scope)
     if isinstance(dep, Pending):
         dep = dep.resolve()
     return dep
 
-def expand(fmt, settings, extra_vars={}):
+# Compile a format string into a function (settings, extra_vars={}) -> str.
+def compile_expander(fmt):
     bits = parse_expander(fmt)
-    return ''.join((bit if isinstance(bit, basestring) else eval_expand_bit(bit[0], settings, extra_vars)) for bit in bits)
+    if len(bits) == 1:
+        literal = bits[0]
+        return lambda settings, extra_vars={}: literal
+    def expander(settings, extra_vars={}):
+        scope = settings.specialize(**extra_vars)
+        return ''.join((bit if isinstance(bit, basestring) else eval_expand_bit(bit[0], scope)) for bit in bits)
+    return expander
+
+# Compile a shell-like format string into a function (settings,
+# extra_vars={}) -> argv.  The split into arguments depends only on the format
+# string, so it is done here; each argument is a list alternating literal
+# strings and (code, should_shlex_result) tuples.
+def compile_argv_expander(fmt):
+    bits = parse_expander(fmt)
+    shell = ''.join(bit if isinstance(bit, basestring) else '(!)' for bit in bits)
+    codes = iter([bit for bit in bits if not isinstance(bit, basestring)])
+    template = []
+    for arg in shlex.split(shell):
+        pieces = arg.split('(!)')
+        parts = [pieces[0]]
+        for piece in pieces[1:]:
+            parts.append(next(codes))
+            parts.append(piece)
+        template.append(parts)
+    def expander(settings, extra_vars={}):
+        scope = settings.specialize(**extra_vars)
+        out_argv = []
+        for parts in template:
+            out_argv.append(parts[0])
+            for i in range(1, len(parts), 2):
+                code, should_shlex_result = parts[i]
+                res = eval_expand_bit(code, scope)
+                res = shlex.split(res) if should_shlex_result else [res]
+                out_argv[-1] += res[0]
+                out_argv.extend(res[1:])
+                out_argv[-1] += parts[i+1]
+        return out_argv
+    return expander
+
+# A bounded LRU cache with hit/miss counters.
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # make() is called to produce the value on a miss
+    def get(self, key, make):
+        with self.lock:
+            try:
+                val = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.data[key] = val
+                self.hits += 1
+                return val
+        val = make()
+        with self.lock:
+            self.data[key] = val
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return val
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+# Compiled expanders, keyed on format string: build_c_objs and friends expand
+# the same handful of patterns for every source file.
+expander_cache = LRUCache(4096)
+
+def expander_cache_stats():
+    return expander_cache.stats()
+
+def expand(fmt, settings, extra_vars={}):
+    return expander_cache.get(('expand', fmt), lambda: compile_expander(fmt))(settings, extra_vars)
 
 def expand_argv(argv, settings, extra_vars={}):
     if isinstance(argv, basestring):
-        bits = parse_expander(argv)
-        shell = ''.join(bit if isinstance(bit, basestring) else '(!)' for bit in bits)
-        codes = [bit for bit in bits if not isinstance(bit, basestring)]
-        argv = shlex.split(shell)
-        out_argv = []
-        for arg in argv:
-            first = True
-            out_argv.append('')
-            for bit in arg.split('(!)'):
-                if not first:
-                    code, should_shlex_result = codes.pop(0)
-                    res = eval_expand_bit(code, settings, extra_vars)
-                    res = shlex.split(res) if should_shlex_result else [res]
-                    out_argv[-1] += res[0]
-                    out_argv.extend(res[1:])
-                first = False
-                out_argv[-1] += bit
-        return out_argv
+        return expander_cache.get(('argv', argv), lambda: compile_argv_expander(argv))(settings, extra_vars)
     else:
         return [expand(arg, settings, extra_vars) for arg in argv]
 
@@ -403,6 +877,11 @@ def _print_help(include_unused=False):
     parser.print_help()
 
 def parse_args():
+    with profiler.span('parse_args', 'phase'):
+        do_parse_args()
+    profiler.parsed_at = time.time()
+
+def do_parse_args():
     will_need(pre_parse_args_will_need)
     default_opt_section.move_to_end()
     parser = _make_argparse(include_unused=True, include_env=False)
@@ -429,7 +908,7 @@ def parse_args():
         _print_help()
         sys.exit(1)
 
-    for opt in all_options:
+    def set_option(opt):
         try:
             if opt.is_env:
                 name = opt.name[:-1]
@@ -439,11 +918,24 @@ def parse_args():
         except DependencyNotFoundException as e:
             def f(): raise e
             post_parse_args_will_need.append(f)
+    # Some on_set callbacks probe (XcodeToolchain.on_set_arch runs xcrun), so
+    # the options that decide where probe results come from go first, and the
+    # replayed state is installed before any of the others.
+    early = [all_options_by_name[name] for name in ('--no-cache', '--recheck', '--replay-state')]
+    for opt in early:
+        set_option(opt)
+    if settings_root.replay_state is not None:
+        config_state.replay(settings_root.replay_state)
+    for opt in all_options:
+        if opt not in early:
+            set_option(opt)
         #print args._unrecognized_args
 
     global did_parse_args
     did_parse_args = True
-    will_need(post_parse_args_will_need)
+    # replayed probes are just lookups, not worth a thread pool
+    will_need(post_parse_args_will_need, jobs=1 if config_state.replaying else settings_root.probe_jobs)
+    config_cache.save()
 
 # -- toolchains --
 class Triple(namedtuple('Triple', 'triple arch vendor os abi')):
@@ -476,7 +968,9 @@ class Machine(object):
 
         self.toolchains = memoize(self.toolchains)
         self.c_tools = memoize(self.c_tools)
-        self.darwin_target_conditionals = memoize(self.darwin_target_conditionals)
+        self.darwin_target_conditionals = memoize(self.darwin_target_conditionals,
+            cache_key=lambda: 'darwin-target-conditionals %s' % (argv_to_shell(self.c_tools().cpp.argv()),),
+            cache_files=lambda result: [self.c_tools().cpp.argv()[0]])
 
         self.flags_section = OptSection('Compiler/linker flags (%s):' % (self.name,))
         self.tools_section = OptSection('Tool overrides (%s):' % (self.name,))
@@ -522,7 +1016,7 @@ class Machine(object):
 
     #memoize
     def darwin_target_conditionals(self):
-        return calc_darwin_target_conditionals(self.c_tools(), self.settings)
+        return calc_darwin_target_conditionals(self.c_tools(), self.settings, self.name)
     def will_need_darwin_target_conditionals(self):
         self.c_tools().cpp.required()
 
@@ -547,6 +1041,10 @@ class CLITool(object):
                 self.argv_from_opt = shlex.split(val)
         self.argv_opt = Option(env + '=', help='Default: %r' % (defaults,), on_set=on_set, show=False, section=section)
         self.argv = memoize(self.argv)
+        # files (other than argv[0]) that the toolchain resolved the tool to
+        self.found_files = []
+        self.argv_non_opt = memoize(self.argv_non_opt, cache_key=self.cache_key,
+                                    cache_files=lambda argv: argv[:1] + self.found_files)
 
     def __repr__(self):
         return 'CLITool(name=%r, defaults=%r, env=%r)' % (self.name, self.defaults, self.env)
@@ -575,7 +1073,20 @@ class CLITool(object):
             log('Using %s from command line: %s\n' % (self.name, argv_to_shell(self.argv_from_opt)))
             return self.argv_from_opt
 
-        return self.argv_non_opt()
+        argv = self.argv_non_opt()
+        if self.argv_non_opt.from_cache:
+            log('Found %s%s: %s (cached)\n' % (
+                self.name,
+                (' for %r' % (self.machine.name,) if self.machine is not None else ''),
+                argv_to_shell(argv)))
+        return argv
+
+    def cache_key(self):
+        return 'tool %s %s %s %s' % (
+            self.machine.name if self.machine is not None else '-',
+            self.machine.triple if self.machine is not None else '-',
+            self.name,
+            ' '.join(tc.cache_ident() for tc in self.toolchains))
 
     # overridable
     def argv_non_opt(self):
@@ -595,19 +1106,66 @@ class CLITool(object):
         raise DependencyNotFoundException
 
     def locate_in_paths(self, prefix, paths):
-        for path in paths:
-            for default in self.defaults:
-                default = prefix + default
-                filename = os.path.join(path, default)
-                if os.path.exists(filename):
-                    return [filename]
+        filename = executable_index(paths).locate([prefix + default for default in self.defaults])
+        return [filename] if filename is not None else None
+
+# An index of the files in each directory of a search path, so that looking up
+# every tool for every machine costs one listdir per directory rather than a
+# stat per (directory, name) pair.  Names are also indexed in lower case, and
+# a directory that can't be listed (execute-only) is probed directly, as is
+# every directory for a name the index doesn't know (e.g. one a filesystem
+# stores in another Unicode normalization).
+class ExecutableIndex(object):
+    def __init__(self, paths):
+        self.paths = paths
+        self.dirs_by_name = {}
+        self.unlisted = []
+        for i, path in enumerate(paths):
+            try:
+                names = os.listdir(path or '.')
+            except OSError:
+                self.unlisted.append(i)
+                continue
+            for name in set(names) | set(name.lower() for name in names):
+                self.dirs_by_name.setdefault(name, []).append(i)
+
+    # Same result as trying os.path.exists on each directory in turn, and each
+    # name within each directory.
+    def locate(self, names):
+        candidates = set()
+        for j, name in enumerate(names):
+            for i in self.dirs_by_name.get(name, []) + self.dirs_by_name.get(name.lower(), []) + self.unlisted:
+                candidates.add((i, j))
+        filename = self.probe(sorted(candidates), names)
+        if filename is None:
+            filename = self.probe([(i, j) for i in range(len(self.paths)) for j in range(len(names)) if (i, j) not in candidates], names)
+        return filename
+
+    def probe(self, pairs, names):
+        for i, j in pairs:
+            filename = os.path.join(self.paths[i], names[j])
+            if os.path.exists(filename): # e.g. broken symlinks
+                return filename
         return None
 
+executable_indexes = {}
+executable_indexes_lock = threading.Lock()
+def executable_index(paths):
+    key = tuple(paths)
+    with executable_indexes_lock:
+        index = executable_indexes.get(key)
+        if index is None:
+            index = executable_indexes[key] = ExecutableIndex(list(paths))
+        return index
+
 class UnixToolchain(object):
     def __init__(self, machine, settings):
         self.machine = machine
         self.settings = settings
 
+    def cache_ident(self):
+        return 'unix'
+
     def find_tool(self, tool, failure_notes):
         # special cases
         if tool.name == 'cpp':
@@ -626,10 +1184,10 @@ class UnixToolchain(object):
             failure_notes.append('detected cross compilation, so searched for %s-%s' % (self.machine.triple.triple, tool.name))
         return tool.locate_in_paths(prefix, self.settings.tool_search_paths)
 
-def calc_darwin_target_conditionals(ctools, settings):
-    if not os.path.exists(settings.out):
-        os.makedirs(settings.out)
-    fn = os.path.join(settings.out, '_calc_darwin_target_conditionals.c')
+# probes for several machines can run at once, so each gets its own file
+def calc_darwin_target_conditionals(ctools, settings, machine_name):
+    makedirs(settings.out)
+    fn = os.path.join(settings.out, '_calc_darwin_target_conditionals-%s.c' % (machine_name,))
     with open(fn, 'w') as fp:
         fp.write('#include <TargetConditionals.h>\n')
     so, se, st = run_command(ctools.cpp.argv() + ['-dM', fn])
@@ -662,6 +1220,14 @@ class XcodeToolchain(object):
         name = '--%sxcode-archs' % (prefix,)
         self.arch_opt = Option(name, help='Comma-separated list of -arch settings for use with an Xcode toolchain', on_set=self.on_set_arch, section=section)
         self.ok = False
+        self.probe_sdk = memoize(self.probe_sdk,
+            cache_key=lambda: 'xcode-sdk %s %s %s' % (self.sdk, self.arch, self.tarch),
+            cache_files=lambda result: ['/usr/bin/xcrun'] + ([result['sdk_platform_path']] if result['sdk_platform_path'] else []))
+
+    def cache_ident(self):
+        if not self.ok:
+            return 'xcode:none'
+        return 'xcode:%s:%s' % (self.sdk, ','.join(self.archs))
 
     def on_set_arch(self, arch):
         self.sdk = self.sdk_opt.value
@@ -678,8 +1244,9 @@ class XcodeToolchain(object):
             is_armish = tarch is not None and tarch.startswith('arm')
             self.sdk = 'iphoneos' if is_armish else 'macosx'
         self.is_ios = 'macos' not in self.sdk
-        # this is used for arch and also serves as a check
-        sdk_platform_path, _, code = run_command(['/usr/bin/xcrun', '--sdk', self.sdk, '--show-sdk-platform-path'])
+        self.arch, self.tarch = arch, tarch
+        probe = self.probe_sdk()
+        code = probe['code']
         if code == 127:
             log('* Failed to run /usr/bin/xcrun\n')
             if some_explicit_xcode_request:
@@ -690,10 +1257,10 @@ class XcodeToolchain(object):
             if some_explicit_xcode_request:
                 raise DependencyNotFoundException
             return
-        self.sdk_platform_path = sdk_platform_path.rstrip()
+        self.sdk_platform_path = probe['sdk_platform_path']
         log('Xcode SDK platform path: %r\n' % (self.sdk_platform_path,))
 
-        self.archs = self.get_archs(arch, tarch)
+        self.archs = probe['archs']
         if self.archs is None:
             log("*** %s default Xcode SDK for %r because %s; pass %s=arch1,arch2 to override\n" % (
                 "Can't use" if some_explicit_xcode_request else "Not using",
@@ -707,6 +1274,19 @@ class XcodeToolchain(object):
         log('Using architectures for %r: %s\n' % (self.machine.name, repr(self.archs) if self.archs != [] else '(native)'))
         self.ok = True
 
+    #memoize
+    def probe_sdk(self):
+        # this is used for arch and also serves as a check
+        sdk_platform_path, _, code = run_command(['/usr/bin/xcrun', '--sdk', self.sdk, '--show-sdk-platform-path'])
+        if code:
+            return {'code': code, 'sdk_platform_path': None, 'archs': None}
+        self.sdk_platform_path = sdk_platform_path.rstrip()
+        return {
+            'code': code,
+            'sdk_platform_path': self.sdk_platform_path,
+            'archs': self.get_archs(self.arch, self.tarch),
+        }
+
     def get_archs(self, arch, tarch):
         if arch:
             return re.sub('\s', '', arch).split(',')
@@ -722,8 +1302,8 @@ class XcodeToolchain(object):
         if self.sdk_platform_path.endswith('MacOSX.platform'):
             # Assume you just wanted to build natively
             return []
-        xcspecs = glob.glob('%s/Developer/Library/Xcode/Specifications/*Architectures.xcspec' % (self.sdk_platform_path,)) + \
-                  glob.glob('%s/Developer/Library/Xcode/PrivatePlugIns/*/Contents/Resources/Device.xcspec' % (self.sdk_platform_path,))
+        xcspecs = sorted(glob.glob('%s/Developer/Library/Xcode/Specifications/*Architectures.xcspec' % (self.sdk_platform_path,))) + \
+                  sorted(glob.glob('%s/Developer/Library/Xcode/PrivatePlugIns/*/Contents/Resources/Device.xcspec' % (self.sdk_platform_path,)))
         for spec in xcspecs:
             def f():
                 try:
@@ -761,6 +1341,7 @@ class XcodeToolchain(object):
             if code != 0:
                 failure_notes.append(sed)
                 return None
+            tool.found_files.append(sod.strip())
             return argv
         return self.find_tool_normal(tool, failure_notes)
 
@@ -773,6 +1354,7 @@ class XcodeToolchain(object):
         if code != 0:
             failure_notes.append(sed)
             return None
+        tool.found_files.append(sod.strip())
         # note: we can't just use the found path because xcrun sets some env magic
         return argv
 
@@ -818,52 +1400,251 @@ class CTools(object):
         self.cppflags_opt = group.add_setting_option('cppflags', 'CPPFLAGS'+suff, 'Flags for $CC/$CXX when not linking (supposed to be used for preprocessor flags)', [], section=machine.flags_section, type=shlex.split)
         settings.enable_werror_opt.need()
         settings.enable_debug_info_opt.need()
+        settings.enable_split_arch_build_opt.need()
+        # only used to merge the slices of a split universal build, so only
+        # machines whose compiler builds several archs at once need it
+        self.lipo.optional_nocheck()
+        def f():
+            if not settings.enable_split_arch_build or not self.cc.argv_opt.show:
+                return
+            try:
+                cc_argv = self.cc.argv()
+            except DependencyNotFoundException:
+                return
+            if len(split_arch_flags(cc_argv)[0]) > 1:
+                self.lipo.argv()
+        post_parse_args_will_need.append(f)
 
 
 # A nicer - but optional - way of doing multiple tests that will print all the
 # errors in one go and exit cleanly
-def will_need(tests):
+# With jobs > 1, tests run on that many threads; their output is still shown
+# in order.  Tests may append more tests to the list while running.
+def will_need(tests, jobs=1):
     failures = 0
-    for test in tests:
-        try:
-            test()
-        except DependencyNotFoundException:
-            failures += 1
+    done = 0
+    while done < len(tests):
+        batch = tests[done:]
+        done = len(tests)
+        if jobs > 1 and len(batch) > 1:
+            errors = run_tests_parallel(batch, jobs)
+        else:
+            errors = map(run_test, batch)
+        for error in errors:
+            if isinstance(error, DependencyNotFoundException):
+                failures += 1
+            elif error is not None:
+                raise error
     if failures > 0:
         log('(%d failure%s.)\n' % (failures, 's' if failures != 1 else ''))
         sys.exit(1)
 
+def run_test(test):
+    try:
+        test()
+    except DependencyNotFoundException as e:
+        return e
+
+# returns a generator of exceptions (or None), one per test, which replays
+# each test's buffered output before yielding its result
+def run_tests_parallel(tests, jobs):
+    buffers = [LogBuffer() for test in tests]
+    errors = [None] * len(tests)
+    todo = list(range(len(tests)))
+    todo_lock = threading.Lock()
+    def worker():
+        while True:
+            with todo_lock:
+                if not todo:
+                    return
+                i = todo.pop(0)
+            log_state.buffer = buffers[i]
+            try:
+                errors[i] = run_test(tests[i])
+            except BaseException as e:
+                errors[i] = e
+            finally:
+                log_state.buffer = None
+    threads = [threading.Thread(target=worker) for i in range(min(jobs, len(tests)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seen = set()
+    for buf, error in zip(buffers, errors):
+        buf.replay(seen)
+        yield error
+
+def default_probe_jobs():
+    try:
+        return min(8, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
 def relpath_if_within(tree, fn):
     rp = os.path.relpath(fn, tree)
     return None if rp.startswith('..'+os.path.sep) else rp
 
-real_out = memoize(lambda: os.path.realpath(settings_root.out))
+# Outputs are checked and removed by their own path rather than the one they
+# resolve to: some (libsubstitute.0.dylib) are symlinks, and removing one should
+# remove the link, not its target.
+abs_out = memoize(lambda: os.path.abspath(settings_root.out))
+
+def is_safe_to_clean(abs_fn, settings):
+    return settings.allow_autoclean_outside_out or relpath_if_within(abs_out(), abs_fn) or abs_fn in safe_to_clean
+
 def clean_files(fns, settings):
-    ro = real_out()
+    ro = abs_out()
     for fn in fns:
-        if not os.path.exists(fn) or os.path.isdir(fn):
+        if not os.path.lexists(fn) or os.path.isdir(fn):
             continue
-        real_fn = os.path.realpath(fn)
-        if not settings.allow_autoclean_outside_out and not relpath_if_within(ro, real_fn) and real_fn not in safe_to_clean:
+        abs_fn = os.path.abspath(fn)
+        if not is_safe_to_clean(abs_fn, settings):
             log("* Would clean %r as previous build leftover, but it isn't in settings.out (%r) so keeping it for safety.\n" % (fn, ro))
             continue
         log('Removing %r\n' % (fn,))
-        os.remove(real_fn)
+        os.remove(abs_fn)
 def plan_clean_target(fns, settings):
-    ro = real_out()
+    ro = abs_out()
     actions = []
     for fn in fns:
-        real_fn = os.path.realpath(fn)
-        if not settings.allow_autoclean_outside_out and not relpath_if_within(ro, real_fn) and real_fn not in safe_to_clean:
+        if not is_safe_to_clean(os.path.abspath(fn), settings):
             actions.append(('log', "* Would clean %r, but it isn't in settings.out (%r) so keeping it for safety." % (fn, ro)))
             continue
         actions.append(('remove', fn))
     return actions
 
+# (out)/mconfig-rules.json maps each output to the hash of the rule (command,
+# inputs and outputs) that builds it and a digest of the contents of its
+# source inputs (those no rule builds).  At the end of configure, outputs
+# whose rule changed are removed in one pass, so the build tool redoes them.
+# So are outputs whose sources changed but are still older than them, e.g.
+# after a source is replaced by an older copy; a plain edit leaves the source
+# newer, and the build tool redoes those itself.  The previous database is
+# read on the first query.  It also keeps each source's size, mtime and
+# digest, so sources that weren't touched aren't read again.
+class RuleDatabase(object):
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.settings_by_out = {}
+        self._previous = None
+        self._digests = None
+        self.files = {}
+
+    def filename(self):
+        return os.path.join(settings_root.out, 'mconfig-rules.json')
+
+    def add(self, outs, ins, rule_hash, settings):
+        for out in outs:
+            self.entries[out] = (rule_hash, ins)
+            self.settings_by_out[out] = settings
+
+    # {'outputs': {out: {'rule': hash, 'inputs': digest}}, 'files': {fn:
+    # [size, mtime, digest]}}; older databases have no input digests
+    def previous(self):
+        if self._previous is None:
+            self._previous = self.load_previous()
+        return self._previous
+
+    def load_previous(self):
+        try:
+            with open(self.filename()) as fp:
+                db = json.load(fp)
+        except (IOError, ValueError):
+            db = None
+        if isinstance(db, dict) and isinstance(db.get('outputs'), dict):
+            return {'outputs': db['outputs'], 'files': db.get('files', {})}
+        if isinstance(db, dict):
+            # a flat map from output to rule hash (or to a record)
+            outputs = {}
+            for out, old in db.items():
+                outputs[out] = old if isinstance(old, dict) else {'rule': old}
+            return {'outputs': outputs, 'files': {}}
+        # from before the database existed
+        try:
+            with open(os.path.join(settings_root.out, 'mconfig-hashes.txt')) as fp:
+                old_hashes = set(json.load(fp))
+        except (IOError, ValueError):
+            return {'outputs': {}, 'files': {}}
+        return {'outputs': {out: {'rule': rule_hash} for out, (rule_hash, ins) in self.entries.items() if rule_hash in old_hashes}, 'files': {}}
+
+    def file_digest(self, fn):
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return 'missing'
+        old = self.previous()['files'].get(fn)
+        if old is not None and old[:2] == [st.st_size, st.st_mtime]:
+            digest = old[2]
+        elif os.path.isdir(fn):
+            digest = 'directory'
+        else:
+            h = hashlib.sha1()
+            with open(fn, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(65536), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+        self.files[fn] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    # The source inputs of out, and the digest of their contents.
+    def inputs_digest(self, out):
+        if self._digests is None:
+            self._digests = {}
+            built = set(map(os.path.abspath, self.entries))
+            for o, (rule_hash, ins) in self.entries.items():
+                sources = [fn for fn in ins if os.path.abspath(fn) not in built]
+                h = hashlib.sha1()
+                for fn in sources:
+                    h.update(('%s %s\n' % (fn, self.file_digest(fn))).encode('utf-8'))
+                self._digests[o] = (sources, h.hexdigest())
+        return self._digests[out]
+
+    def rule_changed(self, out):
+        old = self.previous()['outputs'].get(out)
+        return old is None or old.get('rule') != self.entries[out][0]
+
+    def inputs_changed(self, out):
+        old = self.previous()['outputs'].get(out)
+        return old is None or old.get('inputs') not in (None, self.inputs_digest(out)[1])
+
+    # Outputs the build tool wouldn't redo by itself: their rule changed, or
+    # their sources did without becoming newer than them.
+    def stale_outputs(self):
+        stale = []
+        for out in self.entries:
+            if self.rule_changed(out):
+                stale.append(out)
+            elif self.inputs_changed(out):
+                try:
+                    out_mtime = os.stat(out).st_mtime
+                except OSError:
+                    continue
+                if all(self.files.get(fn, [0, 0])[1] <= out_mtime for fn in self.inputs_digest(out)[0]):
+                    stale.append(out)
+        return stale
+
+    # Removes the stale outputs, and writes the database.
+    def finish(self):
+        by_settings = OrderedDict()
+        for out in self.stale_outputs():
+            by_settings.setdefault(id(self.settings_by_out[out]), (self.settings_by_out[out], []))[1].append(out)
+        for settings, outs in by_settings.values():
+            clean_files(outs, settings)
+        outputs = OrderedDict()
+        for out, (rule_hash, ins) in self.entries.items():
+            outputs[out] = {'rule': rule_hash, 'inputs': self.inputs_digest(out)[1]}
+        makedirs(settings_root.out)
+        write_file_if_changed(self.filename(), json.dumps({'outputs': outputs, 'files': self.files}, indent=0, sort_keys=True) + '\n')
+        try:
+            os.remove(os.path.join(settings_root.out, 'mconfig-hashes.txt'))
+        except OSError:
+            pass
+
 safe_to_clean = set()
 def mark_safe_to_clean(fn, settings=None):
     fn = expand(fn, settings)
-    safe_to_clean.add(os.path.realpath(fn))
+    safe_to_clean.add(os.path.abspath(fn))
 
 def list_mconfig_scripts(settings):
     real_src = os.path.realpath(settings.src)
@@ -881,13 +1662,28 @@ def list_mconfig_scripts(settings):
                         # who knows?
                         continue
             res.append(fn)
-    return res
+    # sys.modules order depends on what happened to be imported first
+    return sorted(set(res))
+
+# While the emitter runs, the contents of each file it writes, by name.
+emission_capture = None
+# Set in the second run of --self-check-emission, which saves the capture
+# there instead of writing anything.
+emission_snapshot_fn = os.environ.get('MCONFIG_EMISSION_SNAPSHOT')
+# Sources configure writes while adding rules (unity files), by name, so the
+# check compares them along with the build files.
+generated_sources = OrderedDict()
 
 def write_file_loudly(fn, data, perm=None):
     fn = relpath_if_within(os.getcwd(), fn) or fn
-    log('Writing %s\n' % (fn,))
-    with open(fn, 'w') as fp:
-        fp.write(data)
+    if emission_capture is not None:
+        emission_capture[fn] = data
+        if emission_snapshot_fn is not None:
+            return
+    if write_file_if_changed(fn, data):
+        log('Writing %s\n' % (fn,))
+    else:
+        log('%s is unchanged\n' % (fn,))
     if perm is not None:
         try:
             os.chmod(fn, perm)
@@ -895,10 +1691,20 @@ def write_file_loudly(fn, data, perm=None):
             log('chmod: %r' % (e,))
 
 class Emitter(object):
+    # whether add_command_raw takes pool=(name, depth); otherwise pools are
+    # run through mconfig-run.py
+    native_pools = False
     def __init__(self, settings):
         self.settings = settings
         self.distclean_paths = self.default_distclean_paths()
         self.all_outs = set()
+        # (outs, ins) of each edge, for script/build-trace-report.py
+        self.traced_edges = []
+        # (outs, ins) of each non-phony edge, for ordering by history
+        self.edge_ios = []
+        # object -> (settings, lipo argv, [(arch, slice)]) for objects
+        # build_c_objs compiled one arch at a time; see link_c_objs
+        self.split_objs = {}
     def pre_output(self):
         assert not hasattr(self, 'did_output')
         self.did_output = True
@@ -917,20 +1723,104 @@ class Emitter(object):
         if 'expand' in kwargs:
             del kwargs['expand']
         if kwargs.get('mkdirs', True):
-            for dirname in set(map(os.path.dirname, outs)):
+            for dirname in sorted(set(map(os.path.dirname, outs)), reverse=True):
                 if dirname:
                     argvs.insert(0, ['mkdir', '-p', dirname])
         if 'mkdirs' in kwargs:
             del kwargs['mkdirs']
+        cacheable = kwargs.get('cacheable', True)
+        if 'cacheable' in kwargs:
+            del kwargs['cacheable']
+        # (name, depth); a depth of None means no limit
+        pool = kwargs.get('pool')
+        if 'pool' in kwargs:
+            del kwargs['pool']
+        if pool is not None and not pool[1]:
+            pool = None
+        if phony and not argvs:
+            ins = self.order_by_history(ins)
         if not phony:
             self.all_outs.update(outs)
+            self.edge_ios.append((outs, ins))
+            sha = hashlib.sha1(json.dumps((outs, ins, argvs)).encode('utf-8')).hexdigest()
             if settings.enable_rule_hashing:
-                sha = hashlib.sha1(json.dumps((outs, ins, argvs)).encode('utf-8')).hexdigest()
-                if sha not in prev_rule_hashes:
-                    clean_files(outs, settings)
-                cur_rule_hashes.add(sha)
+                rule_db.add(outs, ins, sha, settings)
+            wrap = []
+            if settings.action_cache is not None and cacheable and is_action_cacheable(ins, argvs, kwargs.get('depfile')):
+                wrap += action_cache_args(settings, sha, outs, ins, argvs)
+            if settings.enable_build_trace:
+                self.traced_edges.append((list(map(self.filename_rel, outs)), list(map(self.filename_rel, ins))))
+                wrap += ['--trace', build_trace_filename(), '--edge', self.filename_rel(outs[0])]
+            if pool is not None:
+                if self.native_pools:
+                    kwargs['pool'] = pool
+                else:
+                    wrap += ['--pool', os.path.join(settings.out, 'pools', pool[0]), '--pool-depth', str(pool[1])]
+            if wrap:
+                argvs = [mconfig_run_argv() + wrap + ['--cmd', json.dumps(argvs)]]
         return self.add_command_raw(outs, ins, argvs, phony, *args, **kwargs)
 
+    # For each output (relative to the build directory), the longest chain of
+    # work it starts, going by the previous build's timings.  Running edges
+    # in that order keeps the slow ones (typically links) from being left
+    # for last in a parallel build.
+    def history_priorities(self):
+        # the self-check's second run would read the same logs, so it
+        # couldn't tell whether they were what made the output differ
+        if not self.settings.enable_history_order or self.settings.self_check_emission:
+            return {}
+        if not hasattr(self, 'build_history'):
+            self.build_history = load_build_history(self)
+            self.priorities_for = None
+        if not self.build_history:
+            return {}
+        if self.priorities_for == len(self.edge_ios):
+            return self.priorities
+        edges = [(list(map(self.filename_rel, outs)), list(map(self.filename_rel, ins))) for outs, ins in self.edge_ios]
+        producers = {}
+        for i, (outs, ins) in enumerate(edges):
+            for out in outs:
+                producers[out] = i
+        users = [set() for edge in edges]
+        for i, (outs, ins) in enumerate(edges):
+            for fn in ins:
+                j = producers.get(fn)
+                if j is not None and j != i:
+                    users[j].add(i)
+        weights = {}
+        def weight(i):
+            if i not in weights:
+                weights[i] = 0.0
+                own = max(self.build_history.get(out, 0.0) for out in edges[i][0])
+                weights[i] = own + max([weight(j) for j in users[i]] or [0.0])
+            return weights[i]
+        self.priorities = {}
+        for i, (outs, ins) in enumerate(edges):
+            for out in outs:
+                self.priorities[out] = weight(i)
+        self.priorities_for = len(self.edge_ios)
+        return self.priorities
+
+    def order_by_history(self, fns):
+        priorities = self.history_priorities()
+        if not priorities:
+            return fns
+        return sorted(fns, key=lambda fn: -priorities.get(self.filename_rel(fn), 0.0))
+
+    # Stably sorts the edges in bits longest-first, leaving whatever
+    # outs_of returns None for (comments, variables, etc.) in place.
+    def reorder_by_history(self, bits, outs_of):
+        priorities = self.history_priorities()
+        if not priorities:
+            return bits
+        slots = [i for i, bit in enumerate(bits) if outs_of(bit) is not None]
+        def key(bit):
+            return -max(priorities.get(out, 0.0) for out in outs_of(bit))
+        bits = list(bits)
+        for i, bit in zip(slots, sorted([bits[i] for i in slots], key=key)):
+            bits[i] = bit
+        return bits
+
     def default_distclean_paths(self):
         return [
             ['file', 'config.log'],
@@ -946,6 +1836,99 @@ class Emitter(object):
         output = self.output()
         write_file_loudly(fn, output)
 
+# Compiles (anything with a depfile) are left to the compile cache, and edges
+# without inputs have nothing to key on.  dsymutil writes a .dSYM bundle next
+# to its input that isn't one of the edge's outputs, so it can't be restored.
+action_uncacheable_tools = {'dsymutil'}
+def is_action_cacheable(ins, argvs, depfile):
+    if depfile is not None or not ins:
+        return False
+    return not any(os.path.basename(arg) in action_uncacheable_tools for argv in argvs for arg in argv)
+
+def mconfig_run_argv():
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mconfig-run.py')]
+
+# Paths the commands name other than as inputs or outputs, such as
+# -Wl,-order_file,FILE or ldid -SFILE: the outputs can depend on those files
+# too, so mconfig-run.py keys on them as well (on their absence, if they
+# turn out not to be files).  Some flags take a path without reading it.
+path_not_read_flags = {'-install_name', '-rpath', '-Wl,-install_name', '-Wl,-rpath'}
+def flag_referenced_files(argvs, ins, outs):
+    known = set(os.path.abspath(fn) for fn in ins + outs)
+    res = []
+    for argv in argvs:
+        if argv[:2] == ['mkdir', '-p']:
+            continue
+        for i, arg in enumerate(argv[1:], 1):
+            # shell snippets (sh -c) aren't paths
+            if re.search(r'\s', arg) or argv[i-1] in path_not_read_flags or arg.split(',')[:2] in (['-Wl', '-install_name'], ['-Wl', '-rpath']):
+                continue
+            if ',' in arg:
+                candidates = arg.split(',')[1:]
+            elif '=' in arg:
+                candidates = arg.split('=', 1)[1:]
+            elif arg.startswith('-'):
+                candidates = [arg[2:]]
+            else:
+                candidates = [arg]
+            for fn in candidates:
+                if '/' in fn and os.path.abspath(fn) not in known and fn not in res:
+                    res.append(fn)
+    return res
+
+def action_cache_args(settings, key, outs, ins, argvs):
+    argv = ['--action-cache', os.path.abspath(settings.action_cache), '--max-size', settings.action_cache_size, '--key', key]
+    for out in outs:
+        argv += ['--out', out]
+    for fn in ins:
+        argv += ['--in', fn]
+    for fn in flag_referenced_files(argvs, ins, outs):
+        argv += ['--flag-file', fn]
+    return argv
+
+def build_trace_filename():
+    return os.path.join(settings_root.out, 'build-trace.jsonl')
+
+# the edges, for the report to find the critical path through
+def write_build_trace_graph(emitter):
+    graph = [{'outs': outs, 'ins': ins} for outs, ins in emitter.traced_edges]
+    makedirs(settings_root.out)
+    write_file_if_changed(os.path.join(settings_root.out, 'build-trace-graph.json'), json.dumps(graph, indent=0) + '\n')
+
+# Seconds each output took to build last time, by path relative to the build
+# directory, from whichever logs the previous build left: ninja's, the direct
+# emitter's, and --enable-build-trace's.  Later entries win.
+def load_build_history(emitter):
+    history = {}
+    root = dirname(emitter.settings.emit_fn)
+    try:
+        with open(os.path.join(root, '.ninja_log')) as fp:
+            for line in fp:
+                fields = line.rstrip('\n').split('\t')
+                if line.startswith('#') or len(fields) < 4:
+                    continue
+                try:
+                    history[fields[3]] = (int(fields[1]) - int(fields[0])) / 1000.0
+                except ValueError:
+                    continue
+    except IOError:
+        pass
+    for fn, out_key in [(os.path.join(settings_root.out, 'build-log.jsonl'), 'out'),
+                        (build_trace_filename(), 'edge')]:
+        try:
+            with open(fn) as fp:
+                for line in fp:
+                    try:
+                        ent = json.loads(line)
+                        history[ent[out_key]] = ent['end'] - ent['start']
+                    except (ValueError, KeyError, TypeError):
+                        # cut short by an interrupted build
+                        continue
+        except IOError:
+            pass
+    log_to_file('Build history: %d timed outputs\n' % (len(history),))
+    return history
+
 class UnixEmitter(Emitter):
     def add_unix_distclean(self):
         argvs = []
@@ -953,7 +1936,70 @@ class UnixEmitter(Emitter):
             assert kind in ['file', 'dir']
             argvs.append(['rm', ('-rf' if kind == 'dir' else '-f'), path])
         self.add_command_raw(['distclean'], [], argvs, phony=True)
-# In the future it may be desirable to use make variables and nontrivial ninja rules for efficiency.
+# In the future it may be desirable to use make variables for efficiency.
+
+# Recognizes the shapes of the commands generated by build_c_objs and
+# link_c_objs, so that emitters can share one rule between many edges.
+# Returns (steps, n_explicit), where steps has one (kind, name, args) per argv
+# and the first n_explicit ins are the ones the commands take as arguments, or
+# None if some argv doesn't fit:
+#   ('mkdir', 'mkdir', dir)             mkdir -p <directory of the output>
+#   ('cc', 'cc', prefix)                prefix -c -o OUT -MMD -MF DEPFILE IN
+#   ('link', 'link', (ld, ldflags))     ld -o OUT INS... ldflags
+#   ('post', name, prefix)              prefix OUT (dsymutil, ldid -S, ln -s...)
+# Steps of that last shape are only recognized for the tools in
+# post_step_names, so a rule's name always says what it runs.
+def classify_commands(outs, ins, argvs, depfile=None):
+    if len(outs) != 1:
+        return None
+    out = outs[0]
+    steps = []
+    n_explicit = 0
+    for argv in argvs:
+        link = match_link_command(argv, out, ins)
+        if len(argv) == 3 and argv[:2] == ['mkdir', '-p'] and argv[2] == os.path.dirname(out):
+            steps.append(('mkdir', 'mkdir', argv[2]))
+        elif depfile is not None and depfile[0] == 'makefile' and ins and len(argv) > 7 and \
+             argv[-7:] == ['-c', '-o', out, '-MMD', '-MF', depfile[1], ins[0]]:
+            if n_explicit:
+                return None
+            n_explicit = 1
+            steps.append(('cc', 'cc', argv[:-7]))
+        elif link is not None:
+            if n_explicit:
+                return None
+            ld, ldflags, n_explicit = link
+            steps.append(('link', 'link', (ld, ldflags)))
+        elif len(argv) > 1 and argv[-1] == out and post_step_name(argv) is not None:
+            steps.append(('post', post_step_name(argv), argv[:-1]))
+        else:
+            return None
+    names = [name for kind, name, args in steps]
+    if len(set(names)) != len(names):
+        return None
+    return steps, n_explicit
+
+def match_link_command(argv, out, ins):
+    for i in range(len(argv) - 1):
+        if argv[i] == '-o' and argv[i+1] == out:
+            k = 0
+            while k < len(ins) and i+2+k < len(argv) and argv[i+2+k] == ins[k]:
+                k += 1
+            if k == 0:
+                return None
+            return argv[:i], argv[i+2+k:], k
+    return None
+
+post_step_names = {'dsymutil': 'dsymutil', 'ldid': 'ldid', 'codesign': 'codesign', 'strip': 'strip', 'touch': 'stamp', 'ln': 'symlink', 'cp': 'copy'}
+def post_step_name(argv):
+    for arg in argv[:-1]:
+        name = post_step_names.get(os.path.basename(arg))
+        if name is not None:
+            return name
+    return None
+
+NinjaEdge = namedtuple('NinjaEdge', 'outs explicit_ins implicit_ins rule vars pool')
+MakeEdge = namedtuple('MakeEdge', 'outs ins argvs phony depfile shape')
 
 class MakefileEmitter(UnixEmitter):
     def __init__(self, settings):
@@ -989,6 +2035,16 @@ class MakefileEmitter(UnixEmitter):
 
     # depfile = ('makefile', filename) or ('msvc',)
     def add_command_raw(self, outs, ins, argvs, phony=False, depfile=None):
+        if self.settings.enable_compact_makefile:
+            if depfile is not None and depfile[0] != 'makefile':
+                raise ValueError("don't support depfile of type %r" % (depfile[0],))
+            shape = None if phony else classify_commands(outs, ins, argvs, depfile)
+            edge = MakeEdge(outs, ins, argvs, phony, depfile, shape)
+            if 'all' in outs:
+                self.makefile_bits.insert(1, edge)
+            else:
+                self.makefile_bits.append(edge)
+            return
         bit = ''
         outs = ' '.join(map(self.filename_rel_and_escape, outs))
         ins = ' '.join(map(self.filename_rel_and_escape, ins))
@@ -1006,10 +2062,144 @@ class MakefileEmitter(UnixEmitter):
         else:
             self.makefile_bits.append(bit)
 
+    # Compact mode: command prefixes (compiler + flags, linker, link flags)
+    # shared by several edges become make variables, compiles that differ
+    # only in their file names are merged into static pattern rules, and all
+    # depfiles are pulled in by a single -include.
+    def render_bits(self):
+        # group first, so that a pattern rule only counts as one use of its
+        # compiler flags
+        groups = OrderedDict()
+        units = []
+        for bit in self.makefile_bits:
+            if not isinstance(bit, MakeEdge):
+                continue
+            pattern = self.edge_pattern(bit)
+            if pattern is not None:
+                if pattern not in groups:
+                    units.append(bit)
+                groups.setdefault(pattern, []).append(bit)
+            else:
+                units.append(bit)
+        counts = {}
+        for edge in units:
+            for key, val in self.edge_vars(edge):
+                counts[key, val] = counts.get((key, val), 0) + 1
+        hoisted = OrderedDict()
+        numbers = {}
+        def ref(key, val):
+            if counts[key, val] < 2 or not val:
+                return val
+            if (key, val) not in hoisted:
+                numbers[key] = numbers.get(key, 0) + 1
+                hoisted[key, val] = '%s_%d' % (key, numbers[key])
+            return '$(%s)' % (hoisted[key, val],)
+        deps = []
+        out_bits = []
+        for bit in self.makefile_bits:
+            if not isinstance(bit, MakeEdge):
+                out_bits.append(bit)
+                continue
+            if bit.depfile is not None:
+                deps.append(self.filename_rel_and_escape(bit.depfile[1]))
+            pattern = self.edge_pattern(bit)
+            if pattern is None or len(groups[pattern]) == 1:
+                out_bits.append(self.render_edge(bit, ref))
+            elif groups[pattern][0] is bit:
+                out_bits.append(self.render_pattern_rule(pattern, groups[pattern], ref))
+        header = ''.join('%s = %s\n' % (name, val.replace('#', r'\#')) for (key, val), name in hoisted.items())
+        if header:
+            out_bits.insert(1, header)
+        if deps:
+            out_bits.append('DEPS := \\\n%s\n-include $(DEPS)\n' % (' \\\n'.join('  ' + dep for dep in deps),))
+        return out_bits
+
+    @staticmethod
+    def edge_vars(edge):
+        if edge.shape is None:
+            return []
+        res = []
+        for kind, name, args in edge.shape[0]:
+            if kind == 'cc':
+                res.append(('CC', argv_to_shell(args)))
+            elif kind == 'link':
+                res.append(('LD', argv_to_shell(args[0])))
+                res.append(('LDFLAGS', argv_to_shell(args[1])))
+            elif kind == 'post':
+                res.append((name.upper(), argv_to_shell(args)))
+        return res
+
+    # Returns a hashable description of the static pattern rule a compile edge
+    # could be part of, or None.
+    def edge_pattern(self, edge):
+        if edge.shape is None or edge.depfile is None:
+            return None
+        steps, n_explicit = edge.shape
+        kinds = [kind for kind, name, args in steps]
+        if kinds not in (['cc'], ['mkdir', 'cc']):
+            return None
+        out = self.filename_rel(edge.outs[0])
+        src = self.filename_rel(edge.ins[0])
+        dep = self.filename_rel(edge.depfile[1])
+        if not out.endswith('.o') or dep != out[:-2] + '.d':
+            return None
+        for fn in [out, src] + edge.ins[1:]:
+            if '%' in fn or self.filename_escape(fn) != fn:
+                return None
+        out_parts = out[:-2].split('/')
+        src_base, src_ext = os.path.splitext(src)
+        src_parts = src_base.split('/')
+        # the stem is the longest run of trailing path components they share
+        n = 0
+        while n < min(len(out_parts), len(src_parts)) and out_parts[-1-n] == src_parts[-1-n]:
+            n += 1
+        if n == 0:
+            return None
+        out_prefix = ''.join(part + '/' for part in out_parts[:-n])
+        src_prefix = ''.join(part + '/' for part in src_parts[:-n])
+        cc_args = steps[-1][2]
+        return (out_prefix + '%.o', src_prefix + '%' + src_ext,
+                tuple(edge.ins[1:]), 'mkdir' in kinds, tuple(cc_args))
+
+    def render_pattern_rule(self, pattern, group, ref):
+        out_pattern, src_pattern, extra_ins, mkdir, cc_args = pattern
+        bit = '%s: %s: %s\n' % (
+            ' '.join(self.filename_rel(edge.outs[0]) for edge in group),
+            out_pattern,
+            ' '.join([src_pattern] + [self.filename_rel(fn) for fn in extra_ins]))
+        if mkdir:
+            bit += '\tmkdir -p $(@D)\n'
+        bit += '\t%s -c -o $@ -MMD -MF $(@:.o=.d) $<\n' % (ref('CC', argv_to_shell(cc_args)),)
+        return bit
+
+    def render_edge(self, edge, ref):
+        bit = ''
+        outs = ' '.join(map(self.filename_rel_and_escape, edge.outs))
+        ins = ' '.join(map(self.filename_rel_and_escape, edge.ins))
+        if edge.phony:
+            bit += '.PHONY: %s\n' % (outs,)
+        bit += '%s:%s%s\n' % (outs, ' ' if ins else '', ins)
+        steps = edge.shape[0] if edge.shape is not None else [None] * len(edge.argvs)
+        for argv, step in zip(edge.argvs, steps):
+            if step is None or step[0] == 'mkdir':
+                line = argv_to_shell(argv)
+            elif step[0] == 'link':
+                ld, ldflags = step[2]
+                middle = argv[len(ld):len(argv)-len(ldflags)]
+                line = ' '.join(filter(None, [ref('LD', argv_to_shell(ld)), argv_to_shell(middle), ref('LDFLAGS', argv_to_shell(ldflags))]))
+            else:
+                prefix = step[2]
+                key = 'CC' if step[0] == 'cc' else step[1].upper()
+                line = ref(key, argv_to_shell(prefix)) + ' ' + argv_to_shell(argv[len(prefix):])
+            bit += '\t' + line + '\n'
+        return bit
+
     def output(self):
         self.pre_output()
         self.add_all()
         self.add_clean()
+        if self.settings.enable_compact_makefile:
+            return '\n'.join(self.render_bits())
         return '\n'.join(self.makefile_bits)
 
     def emit(self):
@@ -1017,22 +2207,24 @@ class MakefileEmitter(UnixEmitter):
         if self.settings.auto_rerun_config:
             main_mk = self.main_mk()
             makedirs(os.path.dirname(main_mk))
+            # GNU make remakes out-of-date included makefiles and restarts
+            # itself, so regenerating costs nothing when the configure scripts
+            # haven't changed.  The stamp is touched on every configure run,
+            # since config.status may leave main.mk alone.
+            stamp = os.path.join(os.path.dirname(main_mk), 'config.stamp')
             cs_argvs = [['echo', 'Running config.status...'], ['./config.status']]
-            self.add_command_raw([makefile], list_mconfig_scripts(self.settings), cs_argvs)
+            self.add_command_raw([stamp], list_mconfig_scripts(self.settings), cs_argvs)
+            self.makefile_bits.append('include %s\n' % (self.filename_rel_and_escape(stamp),))
             Emitter.emit(self, main_mk)
+            if emission_snapshot_fn is None:
+                write_file_if_changed(stamp, self.banner + '\n')
+                os.utime(stamp, None)
             # Write the stub
-            # TODO is there something better than shell?
-            # TODO avoid deleting partial output?
             stub = '''
 %(banner)s
-_out := $(shell "$(MAKE_COMMAND)" -s -f %(main_mk_arg)s %(makefile_arg)s >&2 || echo fail)
-ifneq ($(_out),fail)
 include %(main_mk)s
-endif
 '''.lstrip() \
             % {
-                'makefile_arg': argv_to_shell([makefile]),
-                'main_mk_arg': argv_to_shell([main_mk]),
                 'main_mk': self.filename_rel_and_escape(main_mk),
                 'banner': self.banner,
             }
@@ -1044,23 +2236,53 @@ endif
         return 'Makefile'
 
 class NinjaEmitter(UnixEmitter):
+    native_pools = True
     def __init__(self, settings):
         Emitter.__init__(self, settings)
         self.ninja_bits = []
-        self.ruleno = 0
+        self.rules = OrderedDict()
+        self.pools = OrderedDict()
     @staticmethod
     def filename_escape(fn):
         if re.search('[\n\0]', fn):
             raise ValueError("your awful filename %r can't be encoded in ninja (probably)" % (fn,))
         return re.sub(r'([ :\$])', r'$\1', fn)
+    @staticmethod
+    def value_escape(val):
+        return val.replace('$', '$$')
 
     def add_command(self, settings, outs, ins, argvs, *args, **kwargs):
         if self.settings.auto_rerun_config:
             kwargs['order_only_ins'] = kwargs.get('order_only_ins', []) + ['build.ninja']
         Emitter.add_command(self, settings, outs, ins, argvs, *args, **kwargs)
 
-    def add_command_raw(self, outs, ins, argvs, phony=False, depfile=None, order_only_ins=[]):
-        bit = ''
+    def add_rule(self, name, command, depfile=None, **attrs):
+        if depfile:
+            if depfile[0] not in ('makefile', 'msvc'):
+                raise ValueError("don't support depfile of type %r" % (depfile[0],))
+            deps = {'makefile': 'gcc', 'msvc': 'msvc'}[depfile[0]]
+            if name != 'cc':
+                name += '_' + deps
+        if name not in self.rules:
+            bit = 'rule %s\n' % (name,)
+            bit += '  command = %s\n' % (command,)
+            if depfile:
+                bit += '  deps = %s\n' % (deps,)
+                bit += '  depfile = $depfile\n'
+            for key, val in sorted(attrs.items()):
+                bit += '  %s = %s\n' % (key, val)
+            self.rules[name] = bit
+        return name
+
+    # Commands that classify_commands recognizes share rules named after their
+    # steps ('cc', 'link_dsymutil', ...) with the varying parts in per-edge
+    # variables; anything else goes through the generic 'cmd' rule.  mkdir
+    # steps are dropped since ninja creates output directories itself.
+    def add_command_raw(self, outs, ins, argvs, phony=False, depfile=None, order_only_ins=[], pool=None):
+        if pool is not None:
+            name, depth = pool
+            if self.pools.setdefault(name, depth) != depth:
+                raise ValueError('pool %r used with depths %d and %d' % (name, self.pools[name], depth))
         if phony:
             if len(argvs) == 0:
                 self.ninja_bits.append('build %s: phony %s%s\n' % (
@@ -1070,29 +2292,81 @@ class NinjaEmitter(UnixEmitter):
                 ))
                 return
             outs2 = ['__phony_' + out for out in outs]
-            bit += 'build %s: phony %s\n' % (' '.join(map(self.filename_rel_and_escape, outs)), ' '.join(map(self.filename_rel_and_escape, outs2)))
+            self.ninja_bits.append('build %s: phony %s\n' % (' '.join(map(self.filename_rel_and_escape, outs)), ' '.join(map(self.filename_rel_and_escape, outs2))))
             outs = outs2
-        rule_name = 'rule_%d' % (self.ruleno,)
-        self.ruleno += 1
-        bit += 'rule %s\n' % (rule_name,)
-        bit += '  command = %s\n' % (' && $\n    '.join(map(argv_to_shell, argvs)))
+        shape = None if phony else classify_commands(outs, ins, argvs, depfile)
+        steps = [step for step in shape[0] if step[0] != 'mkdir'] if shape is not None else []
+        vars = OrderedDict()
+        if steps:
+            n_explicit = shape[1]
+            templates = []
+            for kind, name, args in steps:
+                if kind == 'cc':
+                    templates.append('$ccflags -c -o $out -MMD -MF $depfile $in')
+                    vars['ccflags'] = argv_to_shell(args)
+                elif kind == 'link':
+                    templates.append('$ld -o $out $in $ldflags')
+                    vars['ld'] = argv_to_shell(args[0])
+                    vars['ldflags'] = argv_to_shell(args[1])
+                else:
+                    templates.append('$%s $out' % (name,))
+                    vars[name] = argv_to_shell(args)
+            rule = self.add_rule('_'.join(name for kind, name, args in steps), ' && '.join(templates), depfile)
+            for key, val in vars.items():
+                vars[key] = self.value_escape(val)
+        else:
+            n_explicit = 0
+            rule = self.add_rule('cmd', '$cmd', depfile)
+            vars['cmd'] = ' && $\n    '.join(self.value_escape(argv_to_shell(argv)) for argv in argvs)
         if depfile:
-            if depfile[0] not in ('makefile', 'msvc'):
-                raise ValueError("don't support depfile of type %r" % (depfile[0],))
-            bit += '  deps = %s\n' % ({'makefile': 'gcc', 'msvc': 'msvc'}[depfile[0]],)
-            bit += '  depfile = %s\n' % (self.filename_rel_and_escape(depfile[1]),)
-        bit += 'build %s: %s' % (' '.join(map(self.filename_rel_and_escape, outs),), rule_name)
-        if ins:
-            bit += ' | %s' % (' '.join(map(self.filename_rel_and_escape, ins),))
-        bit += '\n'
-        self.ninja_bits.append(bit)
+            vars['depfile'] = self.filename_rel_and_escape(depfile[1])
+        self.ninja_bits.append(NinjaEdge(outs, ins[:n_explicit], ins[n_explicit:], rule, vars, pool[0] if pool is not None else None))
+
+    # Variable values shared by several edges (typically compiler flags) are
+    # hoisted into top-level variables.
+    def render_bits(self):
+        counts = {}
+        for bit in self.ninja_bits:
+            if isinstance(bit, NinjaEdge):
+                for key, val in bit.vars.items():
+                    counts[key, val] = counts.get((key, val), 0) + 1
+        hoisted = OrderedDict()
+        numbers = {}
+        out_bits = []
+        for bit in self.ninja_bits:
+            if not isinstance(bit, NinjaEdge):
+                out_bits.append(bit)
+                continue
+            text = 'build %s: %s' % (' '.join(map(self.filename_rel_and_escape, bit.outs)), bit.rule)
+            if bit.explicit_ins:
+                text += ' ' + ' '.join(map(self.filename_rel_and_escape, bit.explicit_ins))
+            if bit.implicit_ins:
+                text += ' | ' + ' '.join(map(self.filename_rel_and_escape, bit.implicit_ins))
+            text += '\n'
+            for key, val in bit.vars.items():
+                if counts[key, val] > 1 and '\n' not in val:
+                    if (key, val) not in hoisted:
+                        numbers[key] = numbers.get(key, 0) + 1
+                        hoisted[key, val] = '%s_%d' % (key, numbers[key])
+                    val = '$' + hoisted[key, val]
+                text += '  %s = %s\n' % (key, val)
+            if bit.pool is not None:
+                text += '  pool = %s\n' % (bit.pool,)
+            out_bits.append(text)
+        header = ''.join('%s = %s\n' % (name, val) for (key, val), name in hoisted.items())
+        pools = ['pool %s\n  depth = %d\n' % (name, depth) for name, depth in self.pools.items()]
+        return ([header] if header else []) + pools + list(self.rules.values()) + out_bits
 
     def add_configstatus_rule(self):
         # Unlike with make, we don't need to do this separately, before the
         # other rules are read, because ninja automatically rereads rules when
         # build.ninja has changed.
+        # config.status leaves build.ninja alone if nothing changed; restat
+        # lets ninja notice that.
         cs_argvs = [['echo', 'Running config.status...'], ['./config.status']]
-        self.add_command_raw(['build.ninja'], list_mconfig_scripts(self.settings), cs_argvs)
+        rule = self.add_rule('regen', '$cmd', generator=1, restat=1)
+        cmd = ' && '.join(self.value_escape(argv_to_shell(argv)) for argv in cs_argvs)
+        self.ninja_bits.append(NinjaEdge(['build.ninja'], [], list_mconfig_scripts(self.settings), rule, {'cmd': cmd}, None))
 
     def add_default(self):
         if hasattr(self, 'default_rule'):
@@ -1107,11 +2381,85 @@ class NinjaEmitter(UnixEmitter):
         self.add_default()
         self.add_command_raw(['clean'], [], [['ninja', '-t', 'clean']], phony=True)
         self.add_unix_distclean()
-        return '\n'.join(self.ninja_bits)
+        # ninja before 1.12 starts ready edges in the order they were read
+        self.ninja_bits = self.reorder_by_history(self.ninja_bits, lambda bit: list(map(self.filename_rel, bit.outs)) if isinstance(bit, NinjaEdge) else None)
+        return '\n'.join(self.render_bits())
 
     def default_outfile(self):
         return 'build.ninja'
 
+# Instead of a build script for another tool, writes the graph as JSON for
+# script/mconfig-build.py to execute, plus a small 'build' script that runs
+# it.  Handy where neither make nor ninja is installed.
+class DirectEmitter(UnixEmitter):
+    def __init__(self, settings):
+        Emitter.__init__(self, settings)
+        self.edges = []
+
+    def add_command_raw(self, outs, ins, argvs, phony=False, depfile=None):
+        if depfile is not None and depfile[0] != 'makefile':
+            raise ValueError("don't support depfile of type %r" % (depfile[0],))
+        # like make and ninja, the runner identifies files by path relative
+        # to the build directory
+        self.edges.append(OrderedDict([
+            ('outs', list(map(self.filename_rel, outs))),
+            ('ins', list(map(self.filename_rel, ins))),
+            ('argvs', argvs),
+            ('phony', phony),
+            ('depfile', self.filename_rel(depfile[1]) if depfile is not None else None),
+        ]))
+
+    def add_clean(self):
+        argvs = []
+        for a, b in plan_clean_target(sorted(self.all_outs), self.settings):
+            if a == 'log':
+                argvs.append(['echo', b])
+            elif a == 'remove':
+                argvs.append(['rm', '-f', b])
+        self.add_command_raw(['clean'], [], argvs, phony=True)
+        self.distclean_paths.append(['file', self.settings.emit_fn])
+        self.add_unix_distclean()
+
+    def graph_fn(self):
+        return os.path.join(self.settings.out, 'build-graph.json')
+
+    def stamp_fn(self):
+        return os.path.join(self.settings.out, 'config.stamp')
+
+    def output(self):
+        self.pre_output()
+        self.add_clean()
+        if not hasattr(self, 'default_rule'):
+            log('Warning: %r: no default rule\n' % (self,))
+        graph = OrderedDict([
+            ('root', os.path.abspath(dirname(self.settings.emit_fn))),
+            ('default', getattr(self, 'default_rule', None)),
+            ('edges', self.reorder_by_history(self.edges, lambda edge: None if edge['phony'] else edge['outs'])),
+        ])
+        if self.settings.auto_rerun_config:
+            graph['regen'] = OrderedDict([
+                ('ins', list_mconfig_scripts(self.settings)),
+                ('stamp', self.stamp_fn()),
+                ('argv', ['./config.status']),
+            ])
+        return json.dumps(graph, indent=1) + '\n'
+
+    def emit(self):
+        graph_fn = self.graph_fn()
+        makedirs(os.path.dirname(graph_fn))
+        Emitter.emit(self, graph_fn)
+        if self.settings.auto_rerun_config and emission_snapshot_fn is None:
+            # config.status may leave the graph alone, so the runner compares
+            # the configure scripts against this instead
+            stamp = self.stamp_fn()
+            write_file_if_changed(stamp, '')
+            os.utime(stamp, None)
+        runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mconfig-build.py')
+        script = '#!/bin/sh\n' + argv_to_shell([sys.executable, runner, graph_fn]) + ' "$@"\n'
+        write_file_loudly(self.settings.emit_fn, script, 0o755)
+
+    def default_outfile(self):
+        return 'build'
 
 def add_emitter_option():
     def on_set_generate(val):
@@ -1122,36 +2470,74 @@ def add_emitter_option():
         '--generate',
         'The type of build script to generate.  Options: %s (default makefile)' % (', '.join(emitters.keys()),),
         on_set_generate, default='makefile', section=output_section)
+    settings_root.add_setting_option('enable_compact_makefile', '--enable-compact-makefile', 'Use make variables and pattern rules to keep the generated Makefile short', default=False, bool=True, section=output_section)
+    settings_root.add_setting_option('enable_history_order', '--enable-history-order', 'Order rules and prerequisites longest-first by how long they took in the previous build (the build files then depend on that build\'s logs, so regenerating can change them)', default=False, bool=True, section=output_section)
     settings_root.add_setting_option('emit_fn', '--outfile', 'Output file.  Default: Makefile, build.ninja, etc.', section=output_section, default=lambda: settings_root.emitter.default_outfile())
 
 def config_status():
-    return '#!/bin/sh\n' + argv_to_shell([sys.executable] + sys.argv) + '\n'
+    argv = [sys.executable] + configure_argv() + ['--replay-state=' + config_state.filename()]
+    return '#!/bin/sh\n' + argv_to_shell(argv) + ' "$@"\n'
+
+# Runs configure again with a different hash seed and fails if the build
+# files it would write differ from the ones just written.
+def self_check_emission(emitted):
+    seed = os.environ.get('PYTHONHASHSEED', '')
+    other_seed = str((int(seed) + 1) % 4294967296) if seed.isdigit() else '1'
+    snapshot_fn = os.path.join(settings_root.out, 'emission-check.json')
+    env = dict(os.environ, PYTHONHASHSEED=other_seed, MCONFIG_EMISSION_SNAPSHOT=snapshot_fn)
+    argv = [sys.executable] + configure_argv() + ['--replay-state=' + config_state.filename()]
+    log('Checking emission with PYTHONHASHSEED=%s...\n' % (other_seed,))
+    so, se, status = run_command(argv, env=env)
+    try:
+        with open(snapshot_fn) as fp:
+            snapshot = json.load(fp)
+        os.remove(snapshot_fn)
+    except (IOError, OSError, ValueError):
+        snapshot = None
+    if status != 0 or snapshot is None:
+        log('** --self-check-emission: the second configure run failed (status %d):\n%s%s' % (status, so, se))
+        sys.exit(1)
+    differ = []
+    for fn in sorted(set(emitted) | set(snapshot)):
+        a, b = emitted.get(fn, ''), snapshot.get(fn, '')
+        if a != b:
+            differ.append(fn)
+            log_to_file(''.join(difflib.unified_diff(a.splitlines(True), b.splitlines(True), fn, '%s (PYTHONHASHSEED=%s)' % (fn, other_seed))))
+    if differ:
+        log('** --self-check-emission: %s came out differently (diff in config.log)\n' % (', '.join(differ),))
+        sys.exit(1)
+    log('Emission is reproducible (%d files compared)\n' % (len(emitted),))
 
 def finish_and_emit():
-    settings_root.emitter.emit()
-    if settings_root.enable_rule_hashing:
-        emit_rule_hashes()
-    write_file_loudly('config.status', config_status(), 0o755)
-
-def check_rule_hashes():
-    if not settings_root.enable_rule_hashing:
+    global emission_capture
+    # everything since parse_args was the configure script adding rules
+    profiler.add('rules', 'phase', profiler.parsed_at, time.time(), {})
+    if emission_snapshot_fn is not None:
+        # only the build files matter; caches, config.status and so on are
+        # the first run's business
+        emission_capture = OrderedDict(generated_sources)
+        settings_root.emitter.emit()
+        with open(emission_snapshot_fn, 'w') as fp:
+            json.dump(emission_capture, fp)
         return
-    global prev_rule_hashes, cur_rule_hashes
-    cur_rule_hashes = set()
-    rule_path = os.path.join(settings_root.out, 'mconfig-hashes.txt')
-    try:
-        fp = open(rule_path)
-    except IOError:
-        prev_rule_hashes = set()
-        return
-    prev_rule_hashes = set(json.load(fp))
-    fp.close()
-
-def emit_rule_hashes():
-    makedirs(settings_root.out)
-    rule_path = os.path.join(settings_root.out, 'mconfig-hashes.txt')
-    with open(rule_path, 'w') as fp:
-        json.dump(list(cur_rule_hashes), fp)
+    with profiler.span('finish_and_emit', 'phase'):
+        config_cache.save()
+        config_state.save()
+        if settings_root.enable_rule_hashing:
+            with profiler.span('rule_db.finish', 'phase'):
+                rule_db.finish()
+        with profiler.span('emit', 'phase'):
+            emission_capture = OrderedDict(generated_sources)
+            settings_root.emitter.emit()
+            emitted, emission_capture = emission_capture, None
+        if settings_root.enable_build_trace:
+            write_build_trace_graph(settings_root.emitter)
+        write_file_loudly('config.status', config_status(), 0o755)
+    log_to_file('Expander cache: %(hits)d hits, %(misses)d misses (%(size)d/%(maxsize)d entries)\n' % expander_cache_stats())
+    if settings_root.profile_configure:
+        profiler.save()
+    if settings_root.self_check_emission:
+        self_check_emission(emitted)
 
 def get_else_and(container, key, def_func, transform_func=lambda x: x):
     try:
@@ -1178,7 +2564,39 @@ def get_cc_cmd(my_settings, mach_settings, tools, fn, extra_cflags=[]):
     werror = ['-Werror'] if my_settings.enable_werror else []
     cflags = expand_argv(get_else_and(my_settings, 'override_cflags', lambda: get_cflags(mach_settings, is_cxx)), my_settings)
     cc = expand_argv(get_else_and(my_settings, 'override_cc', lambda: (tools.cxx if is_cxx else tools.cc).argv()), my_settings)
-    return (cc + dbg + werror + include_args + cflags + extra_cflags, is_cxx)
+    # LTO and PGO are no concern of the assembler
+    if os.path.splitext(fn)[1] in ('.s', '.S'):
+        codegen = []
+    else:
+        codegen = lto_flags(my_settings) + pgo_cflags(my_settings)
+    return (cc + dbg + werror + codegen + include_args + cflags + extra_cflags, is_cxx)
+
+def lto_flags(settings):
+    return {None: [], 'full': ['-flto'], 'thin': ['-flto=thin']}[settings.enable_lto]
+
+# settings keys: pgo_generate (True for an instrumented build) and pgo_profile
+# (the merged .profdata to optimize with)
+def pgo_cflags(settings):
+    if settings.get('pgo_generate'):
+        return ['-fprofile-instr-generate']
+    profile = settings.get('pgo_profile')
+    if profile is not None:
+        return ['-fprofile-instr-use=' + expand(profile, settings)]
+    return []
+
+def pgo_ldflags(settings):
+    # for the profiling runtime
+    return ['-fprofile-instr-generate'] if settings.get('pgo_generate') else []
+
+# ThinLTO keeps per-module codegen results here, so a relink after a small
+# change only redoes the modules that changed
+def lto_cache_ldflags(machine, settings):
+    if settings.enable_lto != 'thin':
+        return []
+    cache_dir = os.path.join(settings.out, 'lto-cache')
+    if machine.is_darwin():
+        return ['-Wl,-cache_path_lto,' + cache_dir]
+    return ['-Wl,--thinlto-cache-dir=' + cache_dir]
 
 # emitter:      the emitter to add rules to
 # machine:      machine
@@ -1196,6 +2614,7 @@ def get_cc_cmd(my_settings, mach_settings, tools, fn, extra_cflags=[]):
 #                 override_cc:  override cc altogther; ignored in IDE native mode
 #                 override_obj_fn: the .o file
 #                 extra_deps: dependencies
+#                 unity_build: False to keep the file out of --enable-unity-build groups
 # force_cli:    don't use IDEs' native C/C++ compilation mechanism
 # expand:       call expand on filenames
 # extra_cflags: convenience argument for extra CFLAGS (can also use settings/settings_cb)
@@ -1203,7 +2622,9 @@ def build_c_objs(emitter, machine, settings, sources, headers=[], settings_cb=No
     tools = machine.c_tools()
     any_was_cxx = False
     obj_fns = []
-    ldflag_sets = set()
+    # in first-seen order, not a set, so link commands don't depend on the
+    # hash seed
+    ldflag_sets = []
     my_settings = settings
     if expand:
         _expand = lambda x: globals()['expand'](x, my_settings)
@@ -1232,26 +2653,103 @@ def build_c_objs(emitter, machine, settings, sources, headers=[], settings_cb=No
         if fn.startswith('/'):
             fn = emitter.filename_rel(fn)
 
-        cmd += ['-c', '-o', obj_fn, '-MMD', '-MF', dep_fn, fn]
-
-        env = {
-            'outs': [obj_fn],
-            'ins': [fn] + extra_deps,
-            'cmds': [cmd],
-        }
-
-        mce = settings.get('modify_compile')
-        if mce is not None:
-            mce(env)
-        emitter.add_command(my_settings, env['outs'], env['ins'], env['cmds'], depfile=('makefile', dep_fn), expand=False, mkdirs=True)
+        archs, thin_cmd, arch_pos = split_arch_flags(cmd)
+        if my_settings.enable_split_arch_build and len(archs) > 1:
+            # one compiler process per arch; links take the slices, and only
+            # something that wants the fat object gets a lipo step for it
+            slices = []
+            for arch in archs:
+                slice_fn = arch_variant_fn(obj_fn, arch)
+                slice_dep_fn = arch_variant_fn(dep_fn, arch)
+                add_compile_command(emitter, settings, my_settings, slice_fn, slice_dep_fn, fn, extra_deps, with_single_arch(thin_cmd, arch_pos, arch))
+                slices.append((arch, slice_fn))
+            emitter.split_objs[obj_fn] = (my_settings, tools.lipo.argv(), slices)
+        else:
+            add_compile_command(emitter, settings, my_settings, obj_fn, dep_fn, fn, extra_deps, cmd)
 
         for lset in my_settings.get('obj_ldflag_sets', ()):
-            ldflag_sets.add(tuple(lset))
+            if tuple(lset) not in ldflag_sets:
+                ldflag_sets.append(tuple(lset))
         obj_fns.append(obj_fn)
 
     return obj_fns, any_was_cxx, ldflag_sets
 
-def link_c_objs(emitter, machine, settings, link_type, link_out, objs, link_with_cxx=None, force_cli=False, expand=True, ldflags_from_sets=[]):
+def add_compile_command(emitter, settings, my_settings, obj_fn, dep_fn, fn, extra_deps, cmd):
+    cmd = cmd + ['-c', '-o', obj_fn, '-MMD', '-MF', dep_fn, fn]
+
+    env = {
+        'outs': [obj_fn],
+        'ins': [fn] + extra_deps,
+        'cmds': [cmd],
+    }
+
+    mce = settings.get('modify_compile')
+    if mce is not None:
+        mce(env)
+    if my_settings.compile_cache is not None:
+        env['cmds'] = [compile_cache_argv(my_settings) + c if c is cmd else c for c in env['cmds']]
+    emitter.add_command(my_settings, env['outs'], env['ins'], env['cmds'], depfile=('makefile', dep_fn), expand=False, mkdirs=True)
+
+# Returns (archs, argv without any -arch flags, index the first one was at).
+def split_arch_flags(argv):
+    archs, rest, pos = [], [], None
+    i = 0
+    while i < len(argv):
+        if argv[i] == '-arch' and i + 1 < len(argv):
+            if pos is None:
+                pos = len(rest)
+            archs.append(argv[i+1])
+            i += 2
+        else:
+            rest.append(argv[i])
+            i += 1
+    return archs, rest, pos
+
+def with_single_arch(thin_argv, pos, arch):
+    return thin_argv[:pos] + ['-arch', arch] + thin_argv[pos:]
+
+# foo.o -> foo.arm64.o
+def arch_variant_fn(fn, arch):
+    base, ext = os.path.splitext(fn)
+    return '%s.%s%s' % (base, arch, ext)
+
+# The objects in objs that build_c_objs split by arch, as emitter.split_objs
+# keys; objs may name them by absolute path.
+def split_obj_keys(emitter, objs):
+    keys = {}
+    for obj in objs:
+        key = emitter.filename_rel(obj) if obj.startswith('/') else obj
+        if key in emitter.split_objs:
+            keys[obj] = key
+    return keys
+
+# objs, with each split object replaced by its slice for arch, or left alone
+# if it has none (the linker picks the slice out of a fat file).
+def objs_for_arch(emitter, objs, arch):
+    keys = split_obj_keys(emitter, objs)
+    res = []
+    for obj in objs:
+        slices = dict(emitter.split_objs[keys[obj]][2]) if obj in keys else {}
+        res.append(slices.get(arch, obj))
+    return res
+
+# Adds the lipo step for any split object in objs that doesn't have one yet,
+# for consumers that need the fat file.
+def need_fat_objs(emitter, objs):
+    for obj, key in split_obj_keys(emitter, objs).items():
+        if key in emitter.all_outs:
+            continue
+        my_settings, lipo_argv, slices = emitter.split_objs[key]
+        slice_fns = [fn for _, fn in slices]
+        emitter.add_command(my_settings, [key], slice_fns, [lipo_argv + ['-create', '-output', key] + slice_fns], expand=False, mkdirs=True)
+
+def compile_cache_argv(settings):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compile-cache.py')
+    return [sys.executable, script, '--dir', os.path.abspath(settings.compile_cache), '--max-size', settings.compile_cache_size, '--']
+
+# extra_deps:    files the link depends on besides objs (e.g. an order file)
+# extra_ldflags: appended to the flags for exec and dylib links
+def link_c_objs(emitter, machine, settings, link_type, link_out, objs, link_with_cxx=None, force_cli=False, expand=True, ldflags_from_sets=[], extra_deps=[], extra_ldflags=[]):
     if expand:
         _expand = lambda x: globals()['expand'](x, settings)
         _expand_argv = lambda x: expand_argv(x, settings)
@@ -1259,8 +2757,10 @@ def link_c_objs(emitter, machine, settings, link_type, link_out, objs, link_with
         objs = list(map(_expand, objs))
     else:
         _expand = _expand_argv = lambda x: x
+    extra_deps = list(map(_expand, extra_deps))
     tools = machine.c_tools()
     assert link_type in ('exec', 'dylib', 'staticlib', 'obj')
+    link_ins = objs
     if link_type in ('exec', 'dylib'):
         assert link_with_cxx in (False, True)
         cc_for_link = _expand_argv(get_else_and(settings, 'override_ld', lambda: (tools.cxx if link_with_cxx else tools.cc).argv()))
@@ -1271,28 +2771,118 @@ def link_c_objs(emitter, machine, settings, link_type, link_out, objs, link_with
         mach_settings = settings[machine.name]
         ldflags = get_else_and(settings, 'override_ldflags', lambda:
             mach_settings.app_ldflags + mach_settings.ldflags,
-            _expand_argv)
-        cmds = [cc_for_link + typeflag + ['-o', link_out] + objs + ldflags_from_sets + ldflags]
+            _expand_argv) + _expand_argv(extra_ldflags)
+        optflags = lto_flags(settings) + lto_cache_ldflags(machine, settings) + pgo_ldflags(settings)
+        archs, thin_cc, arch_pos = split_arch_flags(cc_for_link)
+        if settings.enable_split_arch_build and len(archs) > 1:
+            # each arch links its own slices, so it needn't wait for the
+            # other archs' compiles; only the images are glued together
+            slice_outs = []
+            for arch in archs:
+                slice_out = arch_variant_fn(link_out, arch)
+                slice_objs = objs_for_arch(emitter, objs, arch)
+                emitter.add_command(settings, [slice_out], slice_objs + extra_deps, [with_single_arch(thin_cc, arch_pos, arch) + typeflag + optflags + ['-o', slice_out] + slice_objs + ldflags_from_sets + ldflags], expand=False, mkdirs=True, pool=('link', settings.link_pool_depth))
+                slice_outs.append(slice_out)
+            cmds = [tools.lipo.argv() + ['-create', '-output', link_out] + slice_outs]
+            link_ins = slice_outs
+        else:
+            need_fat_objs(emitter, objs)
+            cmds = [cc_for_link + typeflag + optflags + ['-o', link_out] + objs + ldflags_from_sets + ldflags]
         if machine.is_darwin() and settings.enable_debug_info:
             cmds.append(tools.dsymutil.argv() + [link_out])
     elif link_type == 'staticlib':
+        need_fat_objs(emitter, objs)
         cmds = [tools.ar.argv() + ['rcs'] + objs]
     elif link_type == 'obj':
+        need_fat_objs(emitter, objs)
         cmds = [tools.cc.argv() + ['-Wl,-r', '-nostdlib', '-o', link_out] + objs]
     env = {
         'outs': [link_out],
-        'ins': objs,
+        'ins': link_ins + extra_deps,
         'cmds': cmds,
     }
     mce = settings.get('modify_link')
     if mce is not None:
         mce(env)
-    emitter.add_command(settings, env['outs'], env['ins'], env['cmds'], expand=False, mkdirs=True)
+    # links, and the dsymutil and ldid runs that follow them, are heavy on
+    # memory and IO; compiles are left alone
+    emitter.add_command(settings, env['outs'], env['ins'], env['cmds'], expand=False, mkdirs=True, pool=('link', settings.link_pool_depth))
+
+unity_extensions = ('.c', '.m', '.cc', '.cpp', '.cxx', '.mm')
+
+# Replaces runs of sources that would be compiled with the same command by
+# generated files that #include them, at most settings.unity_build_groups per
+# command.  Returns the new sources and a settings_cb that knows about them.
+def plan_unity_build(machine, settings, link_out, sources, settings_cb, expand):
+    _expand = (lambda x: globals()['expand'](x, settings)) if expand else (lambda x: x)
+    tools = machine.c_tools()
+    pools = {}
+    slots = []
+    for fn in map(_expand, sources):
+        my_settings = settings
+        if settings_cb is not None:
+            s = settings_cb(fn)
+            if s is not None:
+                my_settings = s
+        ext = os.path.splitext(fn)[1]
+        if ext not in unity_extensions or not my_settings.get('unity_build', True) or \
+           my_settings.get('override_obj_fn') is not None:
+            slots.append(fn)
+            continue
+        cmd, _ = get_cc_cmd(my_settings, my_settings[machine.name], tools, fn)
+        key = (ext, tuple(cmd), tuple(my_settings.get('extra_compile_deps', [])))
+        if key not in pools:
+            pools[key] = []
+            slots.append(key)
+        pools[key].append((fn, my_settings))
+
+    unity_dir = os.path.join(settings.out, 'unity')
+    base = os.path.splitext(os.path.basename(_expand(link_out)))[0]
+    unity_settings = {}
+    new_sources = []
+    for slot in slots:
+        if not isinstance(slot, tuple):
+            new_sources.append(slot)
+            continue
+        members = pools[slot]
+        n = max(1, min(settings.unity_build_groups, len(members)))
+        for i in range(n):
+            group = members[i * len(members) // n:(i + 1) * len(members) // n]
+            if len(group) == 1:
+                new_sources.append(group[0][0])
+                continue
+            unity_fn = os.path.join(unity_dir, '%s-%d%s' % (base, len(unity_settings), slot[0]))
+            lines = ['/* generated by configure --enable-unity-build */\n']
+            # quoted includes are looked up next to the unity file, and src
+            # may be relative (./configure)
+            lines += ['#include "%s"\n' % (os.path.abspath(fn),) for fn, _ in group]
+            generated_sources[relpath_if_within(os.getcwd(), unity_fn) or unity_fn] = ''.join(lines)
+            if emission_snapshot_fn is None:
+                makedirs(unity_dir)
+                write_file_if_changed(unity_fn, ''.join(lines))
+            ldflag_sets = []
+            for _, my_settings in group:
+                for lset in my_settings.get('obj_ldflag_sets', ()):
+                    if tuple(lset) not in ldflag_sets:
+                        ldflag_sets.append(tuple(lset))
+            unity_settings[unity_fn] = group[0][1].specialize(
+                override_obj_fn=os.path.splitext(unity_fn)[0] + '.o',
+                obj_ldflag_sets=ldflag_sets,
+            )
+            new_sources.append(unity_fn)
+
+    def cb(fn):
+        if fn in unity_settings:
+            return unity_settings[fn]
+        return settings_cb(fn) if settings_cb is not None else None
+    return new_sources, cb
 
 def build_and_link_c_objs(emitter, machine, settings, link_type, link_out, sources, headers=[], objs=[], settings_cb=None, force_cli=False, expand=True, extra_deps=[], extra_cflags=[], extra_ldflags=[]):
+    if settings.enable_unity_build:
+        sources, settings_cb = plan_unity_build(machine, settings, link_out, sources, settings_cb, expand)
     more_objs, link_with_cxx, ldflag_sets = build_c_objs(emitter, machine, settings, sources, headers, settings_cb, force_cli, expand, extra_cflags)
     ldflags_from_sets = [flag for lset in ldflag_sets for flag in lset]
-    link_c_objs(emitter, machine, settings, link_type, link_out, objs + more_objs, link_with_cxx, force_cli, expand, ldflags_from_sets)
+    link_c_objs(emitter, machine, settings, link_type, link_out, objs + more_objs, link_with_cxx, force_cli, expand, ldflags_from_sets, extra_deps, extra_ldflags)
 
 def will_build_and_link_c(machine, link_types=set(), c=True, cxx=False):
     c = machine.c_tools()
@@ -1315,6 +2905,7 @@ def guess_obj_fn(fn, settings):
 
 # -- init code --
 
+profiler = ConfigProfiler()
 init_config_log()
 
 did_parse_args = False
@@ -1332,6 +2923,17 @@ installation_dirs_group(settings_root.new_child('idirs'))
 
 output_section = OptSection('Output options:')
 
+configure_section = OptSection('Configure behavior:')
+settings_root.add_setting_option('disable_config_cache', '--no-cache', "Don't read or write the result cache (out/config.cache)", default=False, bool=True, opposite='--cache', section=configure_section)
+settings_root.add_setting_option('profile_configure', '--profile-configure', 'Time commands, probes and phases of this run; write config-profile.json (Chrome trace) and config-profile.txt', default=False, bool=True, opposite='--no-profile-configure', section=configure_section)
+settings_root.add_setting_option('self_check_emission', '--self-check-emission', 'After writing the build files, run configure again with a different PYTHONHASHSEED and fail if the files would come out differently (turns off --enable-history-order)', default=False, bool=True, opposite='--no-self-check-emission', section=configure_section)
+settings_root.add_setting_option('recheck', '--recheck', 'Ignore cached results and probe everything again', default=False, bool=True, opposite='--no-recheck', section=configure_section)
+settings_root.add_setting_option('probe_jobs', '--probe-jobs', 'Number of dependency checks to run in parallel (default: number of CPUs, up to 8)', default=default_probe_jobs, type=int, section=configure_section)
+settings_root.add_setting_option('replay_state', '--replay-state', 'Reuse the probe results saved in FILE if the command line and environment match (used by config.status)', default=None, metavar='FILE', section=configure_section)
+config_cache = ConfigCache()
+config_state = ConfigState()
+rule_db = RuleDatabase()
+
 triple_options_section = OptSection('System types:')
 settings_root.build_machine = memoize(lambda: Machine('build', settings_root, 'the machine doing the build', lambda: Triple('')))
 settings_root.host_machine = memoize(lambda: settings_root.build_machine() and Machine('host', settings_root, 'the machine that will run the compiled program', lambda: settings_root.build_machine().triple))
@@ -1344,17 +2946,27 @@ settings_root.out = os.path.join(os.getcwd(), 'out')
 
 settings_root.enable_rule_hashing = True
 settings_root.allow_autoclean_outside_out = False
-post_parse_args_will_need.append(check_rule_hashes)
 settings_root.auto_rerun_config = True
 
 settings_root.c_includes = []
 
+settings_root.add_setting_option('compile_cache', '--enable-compile-cache', 'Cache compiler output in DIR, keyed on the preprocessed source (statistics: script/compile-cache.py --dir DIR --stats)', default=None, metavar='DIR')
+settings_root.add_setting_option('compile_cache_size', '--compile-cache-size', 'Maximum size of the compile cache (default 1G)', default='1G', metavar='SIZE')
+settings_root.add_setting_option('action_cache', '--enable-action-cache', 'Reuse outputs of non-compile steps (links, segedit, etc.) from DIR when their inputs are unchanged', default=None, metavar='DIR')
+settings_root.add_setting_option('action_cache_size', '--action-cache-size', 'Maximum size of the action cache (default 1G)', default='1G', metavar='SIZE')
+settings_root.add_setting_option('enable_unity_build', '--enable-unity-build', 'Compile the sources of each library or executable that share flags as a few generated files that #include them', default=False, bool=True)
+settings_root.add_setting_option('unity_build_groups', '--unity-build-groups', 'Number of generated files per set of flags with --enable-unity-build (default 2)', default=2, type=int, metavar='N')
+settings_root.add_setting_option('enable_lto', '--enable-lto', 'Link-time optimization: full or thin (ThinLTO, with a cache in out/lto-cache for incremental links); compare with script/compare-lto.sh', default=None, choices=['full', 'thin'], metavar='full|thin')
+settings_root.add_setting_option('link_pool_depth', '--link-pool-depth', 'Run at most N links (with their lipo, dsymutil and ldid steps) at once; compiles are not limited (default: no limit)', default=None, type=int, metavar='N')
+settings_root.add_setting_option('enable_build_trace', '--enable-build-trace', 'Time every build command into out/build-trace.jsonl (report: script/build-trace-report.py)', default=False, bool=True)
 settings_root.enable_werror_opt = settings_root.add_setting_option('enable_werror', '--enable-werror', 'Turn warnings to errors (default on)', default=True, bool=True, show=False)
 settings_root.enable_debug_info_opt = settings_root.add_setting_option('enable_debug_info', '--enable-debug-info', 'Enable -g', default=False, bool=True, show=False)
+settings_root.enable_split_arch_build_opt = settings_root.add_setting_option('enable_split_arch_build', '--enable-split-arch-build', 'Compile and link each -arch of a universal build separately and merge the results with lipo, so they can run in parallel', default=False, bool=True, show=False)
 
 emitters = {
     'makefile': MakefileEmitter,
     'ninja': NinjaEmitter,
+    'direct': DirectEmitter,
 }
 
 pre_parse_args_will_need.append(add_emitter_option)
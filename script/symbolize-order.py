@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Turns the offsets test/order-recorder.c writes into an ld -order_file:
+#
+#   symbolize-order.py OFFSETS OUT NM-COMMAND... DYLIB
+#
+# NM-COMMAND (e.g. 'xcrun --sdk macosx nm -arch x86_64') is run on DYLIB, the
+# recording copy of the library, and each offset is replaced by the symbol
+# that starts there.  A dylib's __TEXT segment starts at address 0, so the
+# addresses nm prints are offsets from the Mach-O header, which is what the
+# recorder measures from.  Unlike dladdr, nm sees local and hidden symbols.
+import sys, subprocess
+
+def main():
+    if len(sys.argv) < 5:
+        sys.stderr.write('usage: symbolize-order.py OFFSETS OUT NM-COMMAND... DYLIB\n')
+        sys.exit(2)
+    offsets_fn, out_fn, nm_argv = sys.argv[1], sys.argv[2], sys.argv[3:]
+    output = subprocess.check_output(nm_argv)
+    if not isinstance(output, str):
+        output = output.decode('utf-8')
+    names = {}
+    for line in output.splitlines():
+        bits = line.split()
+        # undefined symbols have no address
+        if len(bits) != 3 or bits[1] not in 'tT':
+            continue
+        names.setdefault(int(bits[0], 16), bits[2])
+    res = []
+    seen = set()
+    with open(offsets_fn) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            name = names.get(int(line, 16))
+            # e.g. a function folded into another at link time
+            if name is None or name in seen:
+                continue
+            seen.add(name)
+            res.append(name + '\n')
+    with open(out_fn, 'w') as fp:
+        fp.write(''.join(res))
+
+if __name__ == '__main__':
+    main()
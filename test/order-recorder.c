@@ -0,0 +1,74 @@
+/* Linked into a copy of libsubstitute built with -finstrument-functions
+ * (configure --enable-order-file).  Records each function the first time it
+ * is entered and, at exit, writes their offsets from the library's Mach-O
+ * header in that order to $SUBSTITUTE_ORDER_FILE, one hex number per line.
+ * script/symbolize-order.py turns those into names with nm: dladdr only sees
+ * exported symbols, and most of the library is -fvisibility=hidden. */
+#include <dlfcn.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#define NOINST __attribute__((no_instrument_function))
+
+enum {
+	MAX_FUNCS = 8192,
+	TABLE_SIZE = MAX_FUNCS * 2,
+};
+
+static pthread_mutex_t order_mutex = PTHREAD_MUTEX_INITIALIZER;
+static void *seen[TABLE_SIZE];
+static void *order[MAX_FUNCS];
+static size_t order_count;
+
+NOINST
+void __cyg_profile_func_enter(void *func, void *call_site) {
+	(void) call_site;
+	pthread_mutex_lock(&order_mutex);
+	size_t i = ((uintptr_t) func >> 2) % TABLE_SIZE;
+	while (seen[i] && seen[i] != func)
+		i = (i + 1) % TABLE_SIZE;
+	if (!seen[i] && order_count < MAX_FUNCS) {
+		seen[i] = func;
+		order[order_count++] = func;
+	}
+	pthread_mutex_unlock(&order_mutex);
+}
+
+NOINST
+void __cyg_profile_func_exit(void *func, void *call_site) {
+	(void) func;
+	(void) call_site;
+}
+
+NOINST
+static void write_order_file(void) {
+	const char *fn = getenv("SUBSTITUTE_ORDER_FILE");
+	if (!fn)
+		return;
+	FILE *fp = fopen(fn, "w");
+	if (!fp) {
+		perror(fn);
+		return;
+	}
+	Dl_info self;
+	if (!dladdr((void *) write_order_file, &self)) {
+		fprintf(stderr, "order-recorder: can't find own image\n");
+		fclose(fp);
+		return;
+	}
+	for (size_t i = 0; i < order_count; i++) {
+		Dl_info info;
+		/* only this library's functions go in its order file */
+		if (dladdr(order[i], &info) && info.dli_fbase == self.dli_fbase)
+			fprintf(fp, "0x%lx\n", (unsigned long)
+			        ((uintptr_t) order[i] - (uintptr_t) self.dli_fbase));
+	}
+	fclose(fp);
+}
+
+NOINST __attribute__((constructor))
+static void init_order_recorder(void) {
+	atexit(write_order_file);
+}
@@ -0,0 +1,122 @@
+/* Training for configure --enable-pgo-corpus: hooks each transform-dis test
+ * case through the library's API, so the profile covers the disassembler on
+ * the same corpus test-transform-dis checks it against.  Arguments are pairs
+ * of a case set name, as in transform-dis-cases-NAME.bin, and that file; sets
+ * for other architectures are skipped.  Each case gets a page of its own,
+ * followed by a return so the jump scan has somewhere to stop.  Whether a
+ * hook succeeds doesn't matter, only that the code ran. */
+#include "substitute.h"
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/mman.h>
+
+struct case_set {
+	const char *name;
+	const char *ret;
+	size_t ret_size;
+	uintptr_t thumb;
+};
+
+static const struct case_set case_sets[] = {
+#if defined(__x86_64__)
+	{"x86_64", "\xc3", 1, 0},
+#elif defined(__i386__)
+	{"i386", "\xc3", 1, 0},
+#elif defined(__arm64__) || defined(__aarch64__)
+	{"arm64", "\xc0\x03\x5f\xd6", 4, 0},
+#elif defined(__arm__)
+	{"arm", "\x1e\xff\x2f\xe1", 4, 0},
+	{"thumb", "\x70\x47", 2, 1},
+#endif
+	{NULL, NULL, 0, 0},
+};
+
+static void replacement() {}
+
+static int hook_case(const struct case_set *set, const uint8_t *given,
+					 size_t given_size) {
+	size_t page = (size_t) getpagesize();
+	if (given_size + set->ret_size > page)
+		return -1;
+	uint8_t *code = mmap(NULL, page, PROT_READ | PROT_WRITE,
+						 MAP_PRIVATE | MAP_ANON, -1, 0);
+	if (code == MAP_FAILED)
+		return -1;
+	memcpy(code, given, given_size);
+	memcpy(code + given_size, set->ret, set->ret_size);
+	int ret = -1;
+	if (!mprotect(code, page, PROT_READ | PROT_EXEC)) {
+		void *old;
+		struct substitute_function_hook hook = {
+			(void *) ((uintptr_t) code | set->thumb), replacement, &old, 0, NULL
+		};
+		struct substitute_function_hook_record *record;
+		ret = substitute_hook_functions(&hook, 1, &record, 0);
+		if (!ret)
+			substitute_free_hooks(record, 1);
+	}
+	munmap(code, page);
+	return ret;
+}
+
+/* Same layout test-transform-dis's auto mode reads: "GIVEN" code, then
+ * "EXPECT" and the rewritten code, or "EXPECT_ERR". */
+static void hook_cases(const struct case_set *set, uint8_t *in, size_t in_size) {
+	uint8_t *end = in + in_size;
+	int total = 0, hooked = 0;
+	if (in_size < 5 || memcmp(in, "GIVEN", 5)) {
+		fprintf(stderr, "%s: no cases\n", set->name);
+		exit(1);
+	}
+	in += 5;
+	while (in < end) {
+		uint8_t *given = in;
+		uint8_t *expect = memmem(in, end - in, "EXPECT", 6);
+		if (!expect)
+			break;
+		total++;
+		if (!hook_case(set, given, expect - given))
+			hooked++;
+		in = memmem(expect, end - expect, "GIVEN", 5);
+		if (!in)
+			break;
+		in += 5;
+	}
+	printf("%s: hooked %d of %d cases\n", set->name, hooked, total);
+}
+
+int main(int argc, char **argv) {
+	if (argc % 2 != 1) {
+		fprintf(stderr, "usage: test-pgo-transform-dis [NAME BIN]...\n");
+		return 2;
+	}
+	for (int i = 1; i < argc; i += 2) {
+		const struct case_set *set;
+		for (set = case_sets; set->name; set++) {
+			if (!strcmp(set->name, argv[i]))
+				break;
+		}
+		if (!set->name)
+			continue;
+		FILE *fp = fopen(argv[i + 1], "rb");
+		if (!fp) {
+			perror(argv[i + 1]);
+			return 1;
+		}
+		fseek(fp, 0, SEEK_END);
+		long size = ftell(fp);
+		fseek(fp, 0, SEEK_SET);
+		uint8_t *buf = malloc(size > 0 ? size : 1);
+		if (!buf || fread(buf, 1, size, fp) != (size_t) size) {
+			perror(argv[i + 1]);
+			return 1;
+		}
+		fclose(fp);
+		hook_cases(set, buf, size);
+		free(buf);
+	}
+	return 0;
+}
@@ -0,0 +1,956 @@
+# Tests for the Python side of the build: script/mconfig.py and the helpers
+# the generated build files run.  python -m pytest test/
+import sys, os, re, json, time, tempfile, shutil, subprocess, unittest
+
+script_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script')
+sys.path.insert(0, script_dir)
+
+# importing mconfig opens config.log in the current directory
+work_dir = tempfile.mkdtemp(prefix='mconfig-test-')
+old_cwd = os.getcwd()
+os.chdir(work_dir)
+try:
+    import mconfig
+finally:
+    os.chdir(old_cwd)
+
+# the helper scripts have hyphenated names
+def load_script(name):
+    path = os.path.join(script_dir, name + '.py')
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        return mod
+    import imp
+    return imp.load_source(name.replace('-', '_'), path)
+
+def make_settings(**vals):
+    settings = mconfig.SettingsGroup(name='test')
+    for key, val in vals.items():
+        settings[key] = val
+    return settings
+
+class ExpanderTest(unittest.TestCase):
+    def test_scan_finds_matching_paren(self):
+        fmt = '(f(a, (b)) + [1, 2][0]) tail'
+        self.assertEqual(mconfig.scan_expander_expr(fmt, 1), fmt.index(' tail') - 1)
+
+    def test_scan_skips_parens_in_strings(self):
+        for fmt in ['("a)b")', "(')' + \"(\")", '("\\")")', "('''))''')"]:
+            self.assertEqual(mconfig.scan_expander_expr(fmt, 1), len(fmt) - 1, fmt)
+
+    def test_scan_rejects_bad_input(self):
+        for fmt in ['(a', '(a]', '(a[)', '("a)']:
+            self.assertRaises(SyntaxError, mconfig.scan_expander_expr, fmt, 1)
+
+    def test_expand(self):
+        settings = make_settings(out='build', names=['x', 'y'], flags={'opt': '-O2'})
+        expand = lambda fmt, **kw: mconfig.compile_expander(fmt)(settings, kw)
+        self.assertEqual(expand('no exprs'), 'no exprs')
+        self.assertEqual(expand('(out)/(names[1]).o'), 'build/y.o')
+        self.assertEqual(expand('(flags["opt"])(" )"[1])'), '-O2)')
+        self.assertEqual(expand('((out).upper())'), 'BUILD')
+        self.assertEqual(expand('(out.join(("(", ")")))'), '(build)')
+        self.assertEqual(expand('(x)-(out)', x='extra'), 'extra-build')
+
+    def test_expand_argv(self):
+        settings = make_settings(out='build', flags='-a  "-b c"', empty='')
+        expand_argv = lambda fmt: mconfig.compile_argv_expander(fmt)(settings)
+        self.assertEqual(expand_argv('cc -o (out)/a.o a.c'), ['cc', '-o', 'build/a.o', 'a.c'])
+        # (*x) is split like a shell would, (x) never is
+        self.assertEqual(expand_argv('cc (*flags) -x'), ['cc', '-a', '-b c', '-x'])
+        self.assertEqual(expand_argv('cc (flags)'), ['cc', '-a  "-b c"'])
+        self.assertEqual(expand_argv('pre(*flags)post'), ['pre-a', '-b cpost'])
+        self.assertEqual(expand_argv('"a b(out)" c'), ['a bbuild', 'c'])
+        self.assertEqual(expand_argv('x (" ".join([out, ")"]))'), ['x', 'build )'])
+
+class FrozenSettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.old_did_parse_args = mconfig.did_parse_args
+        mconfig.did_parse_args = True
+        base = make_settings(a=1, b=2)
+        base.new_child('mach').cflags = ['-O2']
+        self.settings = base.specialize(b=3)
+
+    def tearDown(self):
+        mconfig.did_parse_args = self.old_did_parse_args
+
+    def test_flattens_inherited_values(self):
+        frozen = self.settings.freeze()
+        self.assertEqual((frozen.a, frozen.b), (1, 3))
+        self.assertEqual(frozen['mach'].cflags, ['-O2'])
+        self.assertIs(frozen.mach.group_parent, frozen)
+        self.assertIs(frozen.inherit_parent, None)
+
+    def test_rejects_mutation(self):
+        frozen = self.settings.freeze()
+        with self.assertRaises(TypeError):
+            frozen.a = 5
+        with self.assertRaises(TypeError):
+            frozen['c'] = 5
+        with self.assertRaises(TypeError):
+            frozen.mach.cflags = []
+        self.assertEqual(frozen.a, 1)
+
+    def test_specialize_inherits_from_frozen(self):
+        frozen = self.settings.freeze()
+        spec = frozen.specialize(b=4)
+        self.assertIs(spec.inherit_parent, frozen)
+        self.assertEqual((spec.a, spec.b, frozen.b), (1, 4, 3))
+        # child groups come back specialized, so overriding them is allowed
+        spec.mach.cflags = ['-O0']
+        self.assertEqual(spec.mach.cflags, ['-O0'])
+        self.assertEqual(frozen.mach.cflags, ['-O2'])
+        self.assertEqual(spec.specialize().a, 1)
+
+class ExecutableIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-index-test-')
+        self.dirs = []
+        for name in ('a', 'b'):
+            path = os.path.join(self.dir, name)
+            os.mkdir(path)
+            self.dirs.append(path)
+        with open(os.path.join(self.dirs[1], 'cc'), 'w'):
+            pass
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_first_directory_wins(self):
+        with open(os.path.join(self.dirs[0], 'cc'), 'w'):
+            pass
+        index = mconfig.ExecutableIndex(self.dirs)
+        self.assertEqual(index.locate(['gcc', 'cc']), os.path.join(self.dirs[0], 'cc'))
+        self.assertEqual(index.locate(['gcc']), None)
+
+    def test_unlistable_directory_is_probed(self):
+        old_listdir = os.listdir
+        def listdir(path):
+            if path == self.dirs[1]:
+                raise OSError('execute-only')
+            return old_listdir(path)
+        os.listdir = listdir
+        try:
+            index = mconfig.ExecutableIndex(self.dirs)
+        finally:
+            os.listdir = old_listdir
+        self.assertEqual(index.locate(['cc']), os.path.join(self.dirs[1], 'cc'))
+
+    def test_name_in_other_case(self):
+        # as on a case-insensitive filesystem: listed as CC, found as cc
+        os.rename(os.path.join(self.dirs[1], 'cc'), os.path.join(self.dirs[0], 'CC'))
+        old_exists = os.path.exists
+        os.path.exists = lambda fn: old_exists(os.path.join(os.path.dirname(fn), os.path.basename(fn).upper()))
+        try:
+            index = mconfig.ExecutableIndex(self.dirs)
+            self.assertEqual(index.locate(['cc']), os.path.join(self.dirs[0], 'cc'))
+        finally:
+            os.path.exists = old_exists
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-cache-test-')
+        vals = mconfig.settings_root.vals
+        self.old_vals = dict((key, vals[key]) for key in ('out', 'disable_config_cache', 'recheck') if key in vals)
+        mconfig.settings_root.out = self.dir
+        mconfig.settings_root.disable_config_cache = False
+        mconfig.settings_root.recheck = False
+        self.dep = os.path.join(self.dir, 'dep.h')
+        with open(self.dep, 'w') as fp:
+            fp.write('1')
+
+    def tearDown(self):
+        mconfig.settings_root.vals.update(self.old_vals)
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        cache = mconfig.ConfigCache()
+        self.assertEqual(cache.get('probe'), None)
+        cache.put('probe', {'ok': True}, [self.dep])
+        self.assertEqual(cache.get('probe'), ({'ok': True},))
+        cache.save()
+        self.assertEqual(mconfig.ConfigCache().get('probe'), ({'ok': True},))
+
+    def test_dependency_change_invalidates(self):
+        cache = mconfig.ConfigCache()
+        cache.put('probe', 1, [self.dep])
+        mtime = os.stat(self.dep).st_mtime
+        os.utime(self.dep, (mtime + 10, mtime + 10))
+        self.assertEqual(cache.get('probe'), None)
+        self.assertEqual(cache.get('probe'), None)
+
+    def test_fingerprint_mismatch_discards(self):
+        cache = mconfig.ConfigCache()
+        cache.put('probe', 1, [])
+        cache.save()
+        with open(cache.filename()) as fp:
+            data = json.load(fp)
+        data['fingerprint']['PATH'] += ':/elsewhere'
+        with open(cache.filename(), 'w') as fp:
+            json.dump(data, fp)
+        self.assertEqual(mconfig.ConfigCache().get('probe'), None)
+
+    def test_recheck_ignores_saved(self):
+        cache = mconfig.ConfigCache()
+        cache.put('probe', 1, [])
+        cache.save()
+        mconfig.settings_root.recheck = True
+        self.assertEqual(mconfig.ConfigCache().get('probe'), None)
+
+class RuleDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-rules-test-')
+        vals = mconfig.settings_root.vals
+        self.old_vals = dict((key, vals[key]) for key in ('out',) if key in vals)
+        mconfig.settings_root.out = self.dir
+        self.settings = make_settings(allow_autoclean_outside_out=True)
+        self.src = os.path.join(self.dir, 'a.c')
+        self.obj = os.path.join(self.dir, 'a.o')
+        self.write(self.src, 'int a;', -100)
+
+    def tearDown(self):
+        mconfig.settings_root.vals.update(self.old_vals)
+        shutil.rmtree(self.dir)
+
+    def write(self, fn, data, age):
+        with open(fn, 'w') as fp:
+            fp.write(data)
+        t = time.time() + age
+        os.utime(fn, (t, t))
+
+    # the first configure has nothing to compare with, then the build runs
+    def configure_and_build(self):
+        self.configure()
+        self.write(self.obj, 'obj', -50)
+
+    def configure(self, rule_hash='r1'):
+        db = mconfig.RuleDatabase()
+        db.add([self.obj], [self.src], rule_hash, self.settings)
+        db.finish()
+        return db
+
+    def test_unchanged_keeps_outputs(self):
+        self.configure_and_build()
+        db = self.configure()
+        self.assertFalse(db.rule_changed(self.obj))
+        self.assertFalse(db.inputs_changed(self.obj))
+        self.assertTrue(os.path.exists(self.obj))
+
+    def test_rule_change_removes_output(self):
+        self.configure_and_build()
+        self.configure('r2')
+        self.assertFalse(os.path.exists(self.obj))
+
+    def test_edited_source_is_left_to_the_build_tool(self):
+        self.configure_and_build()
+        self.write(self.src, 'int b;', 0)
+        db = self.configure()
+        self.assertTrue(db.inputs_changed(self.obj))
+        self.assertTrue(os.path.exists(self.obj))
+
+    def test_older_copy_of_source_removes_output(self):
+        self.configure_and_build()
+        self.write(self.src, 'int b;', -200)
+        db = self.configure()
+        self.assertTrue(db.inputs_changed(self.obj))
+        self.assertFalse(os.path.exists(self.obj))
+
+    def test_reads_flat_database(self):
+        with open(os.path.join(self.dir, 'mconfig-rules.json'), 'w') as fp:
+            json.dump({self.obj: 'r1'}, fp)
+        self.write(self.obj, 'obj', -50)
+        db = self.configure()
+        self.assertFalse(db.rule_changed(self.obj))
+        self.assertTrue(os.path.exists(self.obj))
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = mconfig.LRUCache(2)
+        made = []
+        def get(key):
+            return cache.get(key, lambda: made.append(key) or key.upper())
+        self.assertEqual(get('a'), 'A')
+        get('b')
+        get('a')  # now b is the oldest
+        get('c')
+        self.assertEqual(list(cache.data), ['a', 'c'])
+        get('b')
+        self.assertEqual(made, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 4, 'size': 2, 'maxsize': 2})
+
+class ClassifyCommandsTest(unittest.TestCase):
+    def test_compile(self):
+        argvs = [['mkdir', '-p', 'out/lib'], ['cc', '-O2', '-c', '-o', 'out/lib/a.o', '-MMD', '-MF', 'out/lib/a.d', 'lib/a.c']]
+        steps, n_explicit = mconfig.classify_commands(['out/lib/a.o'], ['lib/a.c'], argvs, ('makefile', 'out/lib/a.d'))
+        self.assertEqual(steps, [('mkdir', 'mkdir', 'out/lib'), ('cc', 'cc', ['cc', '-O2'])])
+        self.assertEqual(n_explicit, 1)
+
+    def test_link_and_post_steps(self):
+        ins = ['a.o', 'b.o', 'libz.a']
+        argvs = [['cc', '-shared', '-o', 'out/l.dylib', 'a.o', 'b.o', '-lobjc'], ['dsymutil', 'out/l.dylib'], ['/usr/bin/ldid', '-S', 'out/l.dylib']]
+        steps, n_explicit = mconfig.classify_commands(['out/l.dylib'], ins, argvs)
+        self.assertEqual(steps, [
+            ('link', 'link', (['cc', '-shared'], ['-lobjc'])),
+            ('post', 'dsymutil', ['dsymutil']),
+            ('post', 'ldid', ['/usr/bin/ldid', '-S']),
+        ])
+        # libz.a is passed some other way, so only the first two are explicit
+        self.assertEqual(n_explicit, 2)
+
+    def test_post_steps_are_named_for_their_tool(self):
+        steps, n_explicit = mconfig.classify_commands(['out/l.0.dylib'], [], [['ln', '-nfs', 'l.dylib', 'out/l.0.dylib']])
+        self.assertEqual(steps, [('post', 'symlink', ['ln', '-nfs', 'l.dylib'])])
+        # a tool without a name of its own goes through the generic rule
+        self.assertEqual(mconfig.classify_commands(['out/x'], [], [['frob', '--in', 'out/x']]), None)
+
+    def test_unclassifiable(self):
+        classify = mconfig.classify_commands
+        self.assertEqual(classify(['a', 'b'], [], [['touch', 'a', 'b']]), None)
+        self.assertEqual(classify(['a'], [], [['sh', '-c', 'echo > a']]), None)
+        # two links, or two of the same post step
+        self.assertEqual(classify(['o'], ['x.o'], [['cc', '-o', 'o', 'x.o'], ['cc', '-o', 'o', 'x.o']]), None)
+        self.assertEqual(classify(['o'], [], [['strip', 'o'], ['strip', 'o']]), None)
+
+def find_executable(name):
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(d, name), os.X_OK):
+            return True
+    return False
+
+class CompactMakefileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-make-test-')
+        for name in ('src/a', 'src/b', 'src/c', 'lib/d'):
+            mconfig.makedirs(os.path.join(self.dir, os.path.dirname(name)))
+            with open(os.path.join(self.dir, name + '.c'), 'w'):
+                pass
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # names relative to the build directory, as build_c_objs leaves them
+    def makefile(self, compact):
+        old_cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            emitter = mconfig.MakefileEmitter(make_settings(
+                enable_compact_makefile=compact, emit_fn=os.path.join(self.dir, 'Makefile'),
+                out='out', allow_autoclean_outside_out=True))
+            cc = ['cc', '-O2', '-Wall']
+            objs = []
+            for name in ('src/a', 'src/b', 'src/c', 'lib/d'):
+                obj, dep, src = 'out' + name[3:] + '.o', 'out' + name[3:] + '.d', name + '.c'
+                emitter.add_command_raw([obj], [src], [['mkdir', '-p', 'out'], cc + ['-c', '-o', obj, '-MMD', '-MF', dep, src]], depfile=('makefile', dep))
+                objs.append(obj)
+            emitter.add_command_raw(['out/lib.dylib'], objs, [['cc', '-o', 'out/lib.dylib'] + objs + ['-dynamiclib'], ['dsymutil', 'out/lib.dylib']])
+            emitter.add_command_raw(['all'], ['out/lib.dylib'], [], phony=True)
+            emitter.set_default_rule('all')
+            return emitter.output()
+        finally:
+            os.chdir(old_cwd)
+
+    def test_shares_flags_and_rules(self):
+        text = self.makefile(True)
+        self.assertIn('CC_1 = cc -O2 -Wall\n', text)
+        self.assertIn('out/a.o out/b.o out/c.o: out/%.o: src/%.c\n', text)
+        self.assertEqual(text.count('-O2'), 1)
+        self.assertIn('-include $(DEPS)', text)
+        self.assertLess(len(text), len(self.makefile(False)))
+
+    @unittest.skipUnless(find_executable('make'), 'needs make')
+    def test_runs_the_same_commands(self):
+        commands = []
+        for compact in (False, True):
+            with open(os.path.join(self.dir, 'Makefile'), 'w') as fp:
+                fp.write(self.makefile(compact))
+            p = subprocess.Popen(['make', '-n', '-B', '-C', self.dir, 'all'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            so, se = p.communicate()
+            self.assertEqual(p.returncode, 0, se)
+            commands.append([line for line in so.decode('utf-8').splitlines() if not line.startswith('make')])
+        self.assertEqual(commands[0], commands[1])
+
+class WriteIfChangedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-write-test-')
+        self.fn = os.path.join(self.dir, 'Makefile')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unchanged_file_is_left_alone(self):
+        self.assertTrue(mconfig.write_file_if_changed(self.fn, 'all:\n'))
+        os.utime(self.fn, (1000, 1000))
+        self.assertFalse(mconfig.write_file_if_changed(self.fn, 'all:\n'))
+        self.assertEqual(os.stat(self.fn).st_mtime, 1000)
+
+    def test_changed_file_is_replaced(self):
+        mconfig.write_file_if_changed(self.fn, 'all:\n')
+        os.utime(self.fn, (1000, 1000))
+        self.assertTrue(mconfig.write_file_if_changed(self.fn, 'all: foo\n'))
+        with open(self.fn) as fp:
+            self.assertEqual(fp.read(), 'all: foo\n')
+        self.assertNotEqual(os.stat(self.fn).st_mtime, 1000)
+        self.assertEqual(os.listdir(self.dir), ['Makefile'])
+
+    def test_permissions_set_even_if_unchanged(self):
+        mconfig.write_file_if_changed(self.fn, '#!/bin/sh\n')
+        mconfig.write_file_loudly(self.fn, '#!/bin/sh\n', 0o755)
+        self.assertEqual(os.stat(self.fn).st_mode & 0o777, 0o755)
+
+class MakefileStubTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-stub-test-')
+        self.old_cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.old_list_mconfig_scripts = mconfig.list_mconfig_scripts
+        mconfig.list_mconfig_scripts = lambda settings: [os.path.join(self.dir, 'configure')]
+        with open('configure', 'w'):
+            pass
+        os.utime('configure', (1000, 1000))
+        # stands in for rerunning configure, which touches the stamp
+        with open('config.status', 'w') as fp:
+            fp.write('#!/bin/sh\necho ran >> status-runs\ntouch out/config.stamp\n')
+        os.chmod('config.status', 0o755)
+
+    def tearDown(self):
+        mconfig.list_mconfig_scripts = self.old_list_mconfig_scripts
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+
+    def emit(self):
+        emitter = mconfig.MakefileEmitter(make_settings(
+            enable_compact_makefile=False, auto_rerun_config=True, emit_fn='Makefile',
+            out='out', allow_autoclean_outside_out=True))
+        emitter.add_command_raw(['out/x'], [], [['sh', '-c', 'echo built > out/x']])
+        emitter.add_command_raw(['all'], ['out/x'], [], phony=True)
+        emitter.set_default_rule('all')
+        emitter.emit()
+
+    def make(self):
+        p = subprocess.Popen(['make'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        so = p.communicate()[0].decode('utf-8')
+        self.assertEqual(p.returncode, 0, so)
+        return so
+
+    def status_runs(self):
+        try:
+            with open('status-runs') as fp:
+                return len(fp.readlines())
+        except IOError:
+            return 0
+
+    @unittest.skipUnless(find_executable('make'), 'needs make')
+    def test_regenerates_without_a_sub_make(self):
+        self.emit()
+        with open('Makefile') as fp:
+            self.assertEqual(fp.read(), '# Generated by mconfig.py\ninclude out/main.mk\n')
+        self.make()
+        self.assertEqual(self.status_runs(), 0)
+        self.assertTrue(os.path.exists('out/x'))
+        os.utime('out/config.stamp', (2000, 2000))
+        os.utime('configure', (3000, 3000))
+        so = self.make()
+        self.assertEqual(self.status_runs(), 1)
+        self.assertNotIn('Entering directory', so)
+        self.make()
+        self.assertEqual(self.status_runs(), 1)
+
+class DirectEmitterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-direct-test-')
+        self.old_cwd = os.getcwd()
+        os.chdir(self.dir)
+        for fn in ('src.txt', 'hdr.txt'):
+            with open(fn, 'w') as fp:
+                fp.write(fn + '\n')
+            os.utime(fn, (1000, 1000))
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+
+    def emit(self, copy=['cp']):
+        emitter = mconfig.DirectEmitter(make_settings(
+            auto_rerun_config=False, enable_history_order=False, emit_fn='build', out='out',
+            allow_autoclean_outside_out=True))
+        emitter.add_command_raw(['out/a.txt'], ['src.txt'], [['mkdir', '-p', 'out'], copy + ['src.txt', 'out/a.txt']])
+        # hdr.txt is only known from the depfile, like a header
+        emitter.add_command_raw(['out/b.txt'], ['out/a.txt'], [['sh', '-c', 'cat out/a.txt hdr.txt > out/b.txt && echo "out/b.txt: hdr.txt" > out/b.d']], depfile=('makefile', 'out/b.d'))
+        emitter.add_command_raw(['all'], ['out/b.txt'], [], phony=True)
+        emitter.set_default_rule('all')
+        emitter.emit()
+
+    def build(self):
+        p = subprocess.Popen(['./build'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        so = p.communicate()[0].decode('utf-8')
+        self.assertEqual(p.returncode, 0, so)
+        return so
+
+    def test_builds_only_what_changed(self):
+        self.emit()
+        self.build()
+        with open('out/b.txt') as fp:
+            self.assertEqual(fp.read(), 'src.txt\nhdr.txt\n')
+        self.assertIn('no work to do', self.build())
+        with open('hdr.txt', 'w') as fp:
+            fp.write('new\n')
+        t = time.time() + 10
+        os.utime('hdr.txt', (t, t))
+        so = self.build()
+        self.assertIn('cat out/a.txt', so)
+        self.assertNotIn('cp src.txt', so)
+        # a changed command reruns its edge, and so everything after it
+        self.emit(['cp', '-p'])
+        so = self.build()
+        self.assertIn('cp -p src.txt', so)
+        self.assertIn('cat out/a.txt', so)
+
+# Stands in for a compiler: -E prints the source, -c copies it to the object
+# and writes a depfile, and each real compile is noted in compiles.log.
+fake_compiler = '''#!%s
+import sys
+args = sys.argv[1:]
+if args == ['--version']:
+    print('fake cc 1.0')
+elif '-E' in args:
+    sys.stdout.write(open(args[-1]).read())
+else:
+    out, dep, src = args[args.index('-o') + 1], args[args.index('-MF') + 1], args[-1]
+    open(out, 'w').write(open(src).read())
+    open(dep, 'w').write('%%s: %%s\\n' %% (out, src))
+    open('compiles.log', 'a').write(out + '\\n')
+''' % (sys.executable,)
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-compile-cache-test-')
+        self.old_cwd = os.getcwd()
+        os.chdir(self.dir)
+        with open('cc', 'w') as fp:
+            fp.write(fake_compiler)
+        os.chmod('cc', 0o755)
+        with open('a.c', 'w') as fp:
+            fp.write('int a;\n')
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+
+    def compile(self, out):
+        dep = os.path.splitext(out)[0] + '.d'
+        subprocess.check_call([sys.executable, os.path.join(script_dir, 'compile-cache.py'), '--dir', 'cache', '--',
+                               os.path.join(self.dir, 'cc'), '-O2', '-c', '-o', out, '-MMD', '-MF', dep, 'a.c'])
+        with open(out) as fp, open(dep) as dp:
+            return fp.read(), dp.read()
+
+    def compiles(self):
+        try:
+            with open('compiles.log') as fp:
+                return fp.read().split()
+        except IOError:
+            return []
+
+    def stats(self):
+        with open(os.path.join('cache', 'stats.json')) as fp:
+            return json.load(fp)
+
+    def test_hit_restores_object_and_depfile(self):
+        self.assertEqual(self.compile('a.o'), ('int a;\n', 'a.o: a.c\n'))
+        # the same source and flags, built to another object
+        self.assertEqual(self.compile('b.o'), ('int a;\n', 'b.o: a.c\n'))
+        self.assertEqual(self.compiles(), ['a.o'])
+        stats = self.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_source_change_misses(self):
+        self.compile('a.o')
+        with open('a.c', 'w') as fp:
+            fp.write('int b;\n')
+        self.assertEqual(self.compile('a.o')[0], 'int b;\n')
+        self.assertEqual(self.compiles(), ['a.o', 'a.o'])
+
+class HistoryOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-history-test-')
+        vals = mconfig.settings_root.vals
+        self.old_vals = dict((key, vals[key]) for key in ('out',) if key in vals)
+        mconfig.settings_root.out = os.path.join(self.dir, 'out')
+        # ninja's log: start and end in ms, mtime, output
+        with open(os.path.join(self.dir, '.ninja_log'), 'w') as fp:
+            fp.write('# ninja log v5\n')
+            fp.write('0\t100\t0\tout/a.o\t0\n0\t100\t0\tout/b.o\t0\n0\t5000\t0\tout/slow\t0\n')
+
+    def tearDown(self):
+        mconfig.settings_root.vals.update(self.old_vals)
+        shutil.rmtree(self.dir)
+
+    def emitter(self, enabled):
+        emitter = mconfig.DirectEmitter(make_settings(
+            enable_history_order=enabled, self_check_emission=False,
+            emit_fn=os.path.join(self.dir, 'build'), out=os.path.join(self.dir, 'out')))
+        fn = lambda name: os.path.join(self.dir, 'out', name)
+        # b.o feeds the slow link, so it inherits its weight
+        emitter.edge_ios = [([fn('a.o')], []), ([fn('b.o')], []), ([fn('slow')], [fn('b.o')])]
+        return emitter
+
+    def test_default_ignores_history(self):
+        emitter = self.emitter(False)
+        ins = ['out/a.o', 'out/b.o', 'out/slow']
+        self.assertEqual(emitter.order_by_history([os.path.join(self.dir, fn) for fn in ins]), [os.path.join(self.dir, fn) for fn in ins])
+        bits = [{'outs': [fn]} for fn in ins]
+        self.assertEqual(emitter.reorder_by_history(bits, lambda bit: bit['outs']), bits)
+        self.assertFalse(hasattr(emitter, 'build_history'))
+
+    def test_orders_longest_chain_first(self):
+        emitter = self.emitter(True)
+        bits = [{'outs': ['out/a.o']}, '# a comment', {'outs': ['out/b.o']}, {'outs': ['out/slow']}]
+        self.assertEqual(emitter.reorder_by_history(bits, lambda bit: bit['outs'] if isinstance(bit, dict) else None),
+                         [{'outs': ['out/b.o']}, '# a comment', {'outs': ['out/slow']}, {'outs': ['out/a.o']}])
+
+class BuildCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.buildcache = load_script('buildcache')
+        self.dir = tempfile.mkdtemp(prefix='mconfig-buildcache-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_xcrun_tool_index(self):
+        index = self.buildcache.xcrun_tool_index
+        self.assertEqual(index(['/usr/bin/xcrun', '--sdk', 'macosx', '-l', 'cc', '-c']), 4)
+        self.assertEqual(index(['/usr/bin/xcrun', '--sdk', 'macosx']), None)
+        self.assertEqual(index(['cc', '-c']), None)
+        self.assertEqual(self.buildcache.resolve_tool([sys.executable, '-c', '']), (sys.executable, [sys.executable]))
+
+    # both caches keep their entries in a Store; only the layout differs
+    def test_eviction_oldest_first(self):
+        caches = [
+            (load_script('compile-cache').Cache(os.path.join(self.dir, 'cc'), 1 << 20), ['.o', '.d']),
+            (load_script('mconfig-run').ActionCache(os.path.join(self.dir, 'ac'), 1 << 20), ['/0']),
+        ]
+        for cache, suffixes in caches:
+            for n, key in enumerate(['aa1', 'bb2', 'cc3']):
+                base = cache.entry(key)
+                for suffix in suffixes:
+                    self.buildcache.makedirs(os.path.dirname(base + suffix))
+                    with open(base + suffix, 'w') as fp:
+                        fp.write('x' * 10)
+                    os.utime(base + suffix, (1000 + n, 1000 + n))
+                os.utime(os.path.dirname(base + suffixes[0]), (1000 + n, 1000 + n))
+            total = 10 * len(suffixes)
+            self.assertEqual(cache.evict(2 * total), 2 * total)
+            self.assertFalse(os.path.exists(cache.entry('aa1') + suffixes[0]))
+            self.assertTrue(os.path.exists(cache.entry('bb2') + suffixes[0]))
+            self.assertTrue(os.path.exists(cache.entry('cc3') + suffixes[0]))
+
+class ActionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.run = load_script('mconfig-run')
+        self.dir = tempfile.mkdtemp(prefix='mconfig-action-cache-test-')
+        self.plist = os.path.join(self.dir, 'ent.plist')
+        self.write(self.plist, 'a')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, fn, data):
+        with open(fn, 'w') as fp:
+            fp.write(data)
+
+    def test_flag_referenced_files(self):
+        argvs = [
+            ['mkdir', '-p', 'out/lib'],
+            ['cc', '-o', 'out/l', 'out/a.o', '-Wl,-order_file,/src/l.order', '-install_name', '/usr/lib/l.dylib', '-Wl,-rpath,/opt/lib'],
+            ['ldid', '-S/src/ent.plist', 'out/l'],
+            ['env', 'X=out/l', 'sh', '-c', 'out/t > /dev/null'],
+        ]
+        self.assertEqual(mconfig.flag_referenced_files(argvs, ['out/a.o'], ['out/l']), ['/src/l.order', '/src/ent.plist'])
+        # spelled differently from the declared input, but the same file
+        self.assertEqual(mconfig.flag_referenced_files([['cc', '-Wl,-order_file,' + os.path.abspath('x.order')]], ['x.order'], []), [])
+
+    def test_key_covers_flag_files(self):
+        cache = self.run.ActionCache(os.path.join(self.dir, 'cache'), 1 << 20)
+        argvs = [['ldid', '-S' + self.plist, 'out']]
+        key = lambda: cache.key('rule', [], argvs, [self.plist])
+        first = key()
+        self.assertEqual(key(), first)
+        self.write(self.plist, 'b')
+        second = key()
+        self.assertNotEqual(second, first)
+        # a missing file is part of the key, not a reason to give up
+        os.remove(self.plist)
+        self.assertNotIn(key(), (None, first, second))
+
+class CriticalPathTest(unittest.TestCase):
+    def setUp(self):
+        self.report = load_script('build-trace-report')
+
+    def rec(self, seconds):
+        return {'start': 100.0, 'end': 100.0 + seconds}
+
+    def test_longest_chain(self):
+        graph = [
+            {'outs': ['a.o'], 'ins': ['a.c']},
+            {'outs': ['b.o'], 'ins': ['b.c']},
+            {'outs': ['lib'], 'ins': ['a.o', 'b.o']},
+            {'outs': ['test', 'test.dSYM'], 'ins': ['lib', 'test.o']},
+            {'outs': ['test.o'], 'ins': ['test.c']},
+            {'outs': ['all'], 'ins': ['test']},
+        ]
+        latest = {'a.o': self.rec(1), 'b.o': self.rec(5), 'lib': self.rec(2), 'test': self.rec(3), 'test.o': self.rec(9), 'all': self.rec(0.5)}
+        path, total = self.report.critical_path(graph, latest)
+        # test.o alone (9) beats b.o -> lib (7)
+        self.assertEqual([edge['outs'][0] for edge in path], ['test.o', 'test', 'all'])
+        self.assertEqual(total, 12.5)
+
+    def test_time_goes_to_the_wrapped_tool(self):
+        tool_name = load_script('mconfig-run').tool_name
+        cache = [sys.executable, '/src/script/compile-cache.py', '--dir', 'c', '--max-size', '1G', '--']
+        self.assertEqual(tool_name(cache + ['/usr/bin/clang', '-c', 'a.c']), 'clang')
+        self.assertEqual(tool_name(cache + ['/usr/bin/xcrun', '--sdk', 'macosx', 'clang', '-c', 'a.c']), 'clang')
+        self.assertEqual(tool_name(['dsymutil', 'out/l.dylib']), 'dsymutil')
+        self.assertEqual(tool_name([sys.executable, '/src/script/symbolize-order.py', 'a', 'b']), os.path.basename(sys.executable))
+
+    def test_untimed_and_cycles(self):
+        graph = [{'outs': ['x'], 'ins': ['y']}, {'outs': ['y'], 'ins': ['x']}]
+        path, total = self.report.critical_path(graph, {'x': self.rec(1)})
+        self.assertEqual(total, 1.0)
+        self.assertEqual(self.report.critical_path([], {}), ([], 0.0))
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        self.run = load_script('mconfig-run')
+        self.dir = tempfile.mkdtemp(prefix='mconfig-pool-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_depth_limits_holders(self):
+        root = os.path.join(self.dir, 'link')
+        pools = [self.run.Pool(root, 2) for i in range(3)]
+        self.assertTrue(pools[0].try_acquire())
+        self.assertTrue(pools[1].try_acquire())
+        self.assertFalse(pools[2].try_acquire())
+        pools[0].release()
+        self.assertTrue(pools[2].try_acquire())
+        for pool in pools:
+            pool.release()
+
+    def test_acquire_waits_for_release(self):
+        import threading
+        root = os.path.join(self.dir, 'link')
+        holder, waiter = self.run.Pool(root, 1), self.run.Pool(root, 1)
+        holder.try_acquire()
+        old_makeflags = os.environ.pop('MAKEFLAGS', None)
+        timer = threading.Timer(0.2, holder.release)
+        timer.start()
+        try:
+            start = time.time()
+            waiter.acquire()
+            self.assertGreaterEqual(time.time() - start, 0.15)
+        finally:
+            timer.join()
+            waiter.release()
+            if old_makeflags is not None:
+                os.environ['MAKEFLAGS'] = old_makeflags
+
+class StubTool(object):
+    def __init__(self, argv):
+        self._argv = argv
+    def argv(self):
+        return self._argv
+
+class StubTools(object):
+    cc = StubTool(['cc', '-arch', 'x86_64', '-arch', 'arm64'])
+    cxx = cc
+    lipo = StubTool(['lipo'])
+    dsymutil = StubTool(['dsymutil'])
+    ar = StubTool(['ar'])
+
+class StubUniversalMachine(object):
+    name = 'test'
+    def c_tools(self):
+        return StubTools()
+    def is_darwin(self):
+        return True
+
+class RecordingEmitter(object):
+    def __init__(self):
+        self.split_objs = {}
+        self.all_outs = set()
+        self.edges = {}
+    def filename_rel(self, fn):
+        return os.path.relpath(fn, '/build')
+    def add_command(self, settings, outs, ins, argvs, **kwargs):
+        self.all_outs.update(outs)
+        for out in outs:
+            self.edges[out] = (ins, argvs)
+
+class SplitArchTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = mconfig.settings_root.specialize(
+            src='/src', out='out', enable_split_arch_build=True,
+            override_cflags=[], override_ldflags=[], c_includes=[],
+            compile_cache=None, link_pool_depth=None, enable_lto=None,
+            enable_debug_info=False, enable_werror=False, test=make_settings())
+        self.emitter = RecordingEmitter()
+
+    def test_slices_link_their_own_arch(self):
+        objs, _, _ = mconfig.build_c_objs(self.emitter, StubUniversalMachine(), self.settings, ['/src/a.c', '/src/b.c'])
+        self.assertEqual(objs, ['out/a.o', 'out/b.o'])
+        # the objects are never made fat just to be linked
+        self.assertNotIn('out/a.o', self.emitter.edges)
+        # an absolute name for a split object finds it too
+        mconfig.link_c_objs(self.emitter, StubUniversalMachine(), self.settings, 'dylib', 'out/lib.dylib', objs[:1] + ['/build/out/b.o', 'out/other.o'], link_with_cxx=False)
+        ins, argvs = self.emitter.edges['out/lib.arm64.dylib']
+        self.assertEqual(ins, ['out/a.arm64.o', 'out/b.arm64.o', 'out/other.o'])
+        self.assertIn('out/a.arm64.o', argvs[0])
+        self.assertNotIn('out/a.x86_64.o', argvs[0])
+        ins, argvs = self.emitter.edges['out/lib.dylib']
+        self.assertEqual(ins, ['out/lib.x86_64.dylib', 'out/lib.arm64.dylib'])
+        self.assertEqual(argvs[0], ['lipo', '-create', '-output', 'out/lib.dylib', 'out/lib.x86_64.dylib', 'out/lib.arm64.dylib'])
+
+    def test_fat_object_made_when_wanted(self):
+        objs, _, _ = mconfig.build_c_objs(self.emitter, StubUniversalMachine(), self.settings, ['/src/a.c'])
+        mconfig.link_c_objs(self.emitter, StubUniversalMachine(), self.settings, 'staticlib', 'out/liba.a', objs)
+        ins, argvs = self.emitter.edges['out/a.o']
+        self.assertEqual(ins, ['out/a.x86_64.o', 'out/a.arm64.o'])
+        self.assertEqual(argvs[0][:4], ['lipo', '-create', '-output', 'out/a.o'])
+
+class UnityBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-unity-test-')
+        self.settings = mconfig.settings_root.specialize(
+            src='/src', out=self.dir, override_cflags=['-O2'], c_includes=[],
+            enable_debug_info=False, enable_werror=False, enable_lto=None,
+            unity_build_groups=1, test=make_settings())
+        self.sources = ['/src/a.c', '/src/b.c', '/src/asm.S', '/src/c.c', '/src/d.c']
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def plan(self, settings_cb=None):
+        sources, cb = mconfig.plan_unity_build(StubUniversalMachine(), self.settings, 'out/lib.dylib', self.sources, settings_cb, False)
+        included = {}
+        for fn in sources:
+            if fn.startswith(self.dir):
+                with open(fn) as fp:
+                    included[fn] = re.findall(r'#include "(.*)"', fp.read())
+        return sources, cb, included
+
+    def test_groups_sources_compiled_alike(self):
+        # c.c has flags of its own, and the assembler file isn't C
+        special = self.settings.specialize(override_cflags=['-O0'])
+        sources, cb, included = self.plan(lambda fn: special if fn == '/src/c.c' else None)
+        unity_fn = os.path.join(self.dir, 'unity', 'lib-0.c')
+        self.assertEqual(sources, [unity_fn, '/src/asm.S', '/src/c.c'])
+        self.assertEqual(included[unity_fn], ['/src/a.c', '/src/b.c', '/src/d.c'])
+        self.assertEqual(cb(unity_fn).override_obj_fn, os.path.join(self.dir, 'unity', 'lib-0.o'))
+        self.assertIs(cb('/src/c.c'), special)
+
+    def test_splits_into_groups(self):
+        self.settings.unity_build_groups = 2
+        sources, cb, included = self.plan()
+        self.assertEqual([included[fn] for fn in sources if fn in included],
+                         [['/src/a.c', '/src/b.c'], ['/src/c.c', '/src/d.c']])
+        self.assertIn('/src/asm.S', sources)
+
+class SelfCheckEmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mconfig-self-check-test-')
+        vals = mconfig.settings_root.vals
+        self.old_vals = dict((key, vals[key]) for key in ('out',) if key in vals)
+        mconfig.settings_root.out = self.dir
+        self.old_run_command, self.old_argv = mconfig.run_command, sys.argv
+        sys.argv = ['configure', '--enable-tests', '--replay-state=old.json']
+        self.runs = []
+
+    def tearDown(self):
+        mconfig.run_command, sys.argv = self.old_run_command, self.old_argv
+        mconfig.settings_root.vals.update(self.old_vals)
+        shutil.rmtree(self.dir)
+
+    # stands in for the second configure run, which writes what it would
+    # have emitted to the snapshot file
+    def rerun_emitting(self, snapshot, status=0):
+        def run_command(argv, env=None, **kwargs):
+            self.runs.append((argv, env))
+            if snapshot is not None:
+                with open(env['MCONFIG_EMISSION_SNAPSHOT'], 'w') as fp:
+                    json.dump(snapshot, fp)
+            return '', '', status
+        mconfig.run_command = run_command
+
+    def test_identical_rerun_passes(self):
+        self.rerun_emitting({'Makefile': 'all:\n'})
+        old_seed = os.environ.pop('PYTHONHASHSEED', None)
+        try:
+            mconfig.self_check_emission({'Makefile': 'all:\n'})
+        finally:
+            if old_seed is not None:
+                os.environ['PYTHONHASHSEED'] = old_seed
+        (argv, env), = self.runs
+        self.assertEqual(env['PYTHONHASHSEED'], '1')
+        self.assertEqual(argv[1:3], ['configure', '--enable-tests'])
+        self.assertEqual(argv[-1], '--replay-state=' + mconfig.config_state.filename())
+        self.assertFalse(os.path.exists(env['MCONFIG_EMISSION_SNAPSHOT']))
+
+    def test_seed_is_changed(self):
+        self.rerun_emitting({})
+        old_seed = os.environ.get('PYTHONHASHSEED')
+        os.environ['PYTHONHASHSEED'] = '41'
+        try:
+            mconfig.self_check_emission({})
+        finally:
+            if old_seed is None:
+                del os.environ['PYTHONHASHSEED']
+            else:
+                os.environ['PYTHONHASHSEED'] = old_seed
+        self.assertEqual(self.runs[0][1]['PYTHONHASHSEED'], '42')
+
+    def test_difference_fails(self):
+        self.rerun_emitting({'Makefile': 'all: b a\n'})
+        with self.assertRaises(SystemExit):
+            mconfig.self_check_emission({'Makefile': 'all: a b\n'})
+
+    def test_failed_rerun_fails(self):
+        self.rerun_emitting(None, status=1)
+        with self.assertRaises(SystemExit):
+            mconfig.self_check_emission({'Makefile': 'all:\n'})
+
+class StubMachine(object):
+    name = 'test'
+    triple = mconfig.Triple('x86_64-apple-darwin10')
+
+class ReplayTest(unittest.TestCase):
+    # config.status passes --replay-state; probes done by on_set callbacks
+    # (the Xcode SDK and arch checks) must come from it too
+    def test_replayed_run_spawns_no_xcrun(self):
+        toolchain = mconfig.XcodeToolchain(StubMachine(), mconfig.settings_root)
+        state_fn = os.path.join(work_dir, 'config-state.json')
+        old_argv, old_run_command = sys.argv, mconfig.run_command
+        commands = []
+        def run_command(cmd, *args, **kwargs):
+            commands.append(cmd)
+            return '', '', 1
+        try:
+            sys.argv = ['configure', '--no-cache', '--replay-state=' + state_fn]
+            mconfig.run_command = run_command
+            with open(state_fn, 'w') as fp:
+                json.dump({
+                    'fingerprint': mconfig.config_state.fingerprint(),
+                    'results': {'xcode-sdk macosx None x86_64': {'code': 0, 'sdk_platform_path': '/X/MacOSX.platform', 'archs': ['x86_64']}},
+                }, fp)
+            mconfig.do_parse_args()
+        finally:
+            sys.argv, mconfig.run_command = old_argv, old_run_command
+        self.assertTrue(mconfig.config_state.replaying)
+        self.assertEqual([cmd for cmd in commands if 'xcrun' in cmd[0]], [])
+        self.assertTrue(toolchain.ok)
+        self.assertEqual(toolchain.archs, ['x86_64'])
+
+if __name__ == '__main__':
+    unittest.main()